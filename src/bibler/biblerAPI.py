@@ -5,24 +5,32 @@ GET    Read                 200 (OK), list of customers. Use pagination, sorting
 PUT    Update/Replace       405 (Method Not Allowed), unless you want to update/replace every resource in the entire collection. 	200 (OK) or 204 (No Content). 404 (Not Found), if ID not found or invalid.
 PATCH  Update/Modify        405 (Method Not Allowed), unless you want to modify the collection itself. 	                            200 (OK) or 204 (No Content). 404 (Not Found), if ID not found or invalid.
 DELETE Delete               405 (Method Not Allowed), unless you want to delete the whole collection—not often desirable. 	        200 (OK). 404 (Not Found), if ID not found or invalid."""
+import asyncio
 import io
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import RedirectResponse
 
 from .books.books_router import books
+from .books.fuzzy import rebuild_trigrams, trigrams_missing
 from .configuration import default_conf
 from .dataclasses.Category import Category, CategoryTable
-from .db.repository import Session
-from .files.files_router import (import_books_csv_from_path,
+from .db.query_cache import CATEGORIES, query_cache
+from .db.repository import Session, get_session, session_scope
+from .files.files_router import (files, import_books_csv_from_path,
                                  import_user_csv_from_path)
-from .media.media_router import media
+from .media.media_router import covers, media
+from .media.thumbnails import thumbnails
+from .search.typeahead import rebuild_typeahead
+from .stats.counters import counters
+from .stats.rollups import rebuild_rollups, rollups_missing
 from .stats.statistics_router import stats
 from .testdata.TestData import (create_categories_data,
                                 create_overdue_borrowed_book,
@@ -78,37 +86,71 @@ bibler.include_router(
     stats,
     prefix="/stats"
 )
+bibler.include_router(
+    files
+)
 
 
 @bibler.on_event("startup")
 async def startup_event():
+    # all endpoints that touch the database or the file system are plain
+    # functions which starlette runs in the default executor of the loop,
+    # bound the number of threads so that a burst of requests cannot open
+    # an unlimited number of database connections
+    asyncio.get_event_loop().set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=default_conf.getint("worker_threads", 8),
+            thread_name_prefix="bibler-worker"
+        )
+    )
+    covers.scan()
     if default_conf["production"] == "true":
+        with session_scope() as session:
+            if rollups_missing(session):
+                rebuild_rollups(session)
+            if trigrams_missing(session):
+                rebuild_trigrams(session)
+            rebuild_typeahead(session)
+        counters.recount()
         return
-    session = Session()
-    create_users_test_data(session)
-    session.commit()
-    session = Session()
-    create_categories_data(session)
-    session.commit()
-    session = Session()
-    create_overdue_borrowed_book(session)
-    session.commit()
-    await import_books_csv_from_path("data/Bücherliste.csv")
-    await import_books_csv_from_path("data/Bücherliste2.csv")
-    await import_user_csv_from_path("data/Userliste.csv")
-
-    await borrow_book(1, 1)
-    await borrow_book(2, 2)
-    await borrow_book(2, 3)
-    await borrow_book(2, 4)
-    await borrow_book(1, 5)
+    with session_scope() as session:
+        create_users_test_data(session)
+    with session_scope() as session:
+        create_categories_data(session)
+    with session_scope() as session:
+        create_overdue_borrowed_book(session)
+    with session_scope() as session:
+        import_books_csv_from_path("data/Bücherliste.csv", session)
+        import_books_csv_from_path("data/Bücherliste2.csv", session)
+        import_user_csv_from_path("data/Userliste.csv", session)
+
+        borrow_book(1, 1, session=session)
+        borrow_book(2, 2, session=session)
+        borrow_book(2, 3, session=session)
+        borrow_book(2, 4, session=session)
+        borrow_book(1, 5, session=session)
+    with session_scope() as session:
+        # the test data is inserted without going through the rollups
+        rebuild_rollups(session)
+        rebuild_typeahead(session)
+    counters.recount()
+
+
+@bibler.on_event("shutdown")
+def shutdown_event():
+    thumbnails.close()
 
 
 @bibler.get("/category", response_model=List[Category])
-async def get_category():
+def get_category(session=Depends(get_session)):
     """returns a list of all existing categories"""
-    session = Session()
-    return [Category(**(i.__dict__)) for i in session.query(CategoryTable).all()]
+    return query_cache.get(
+        ("categories",),
+        (CATEGORIES,),
+        lambda: [
+            Category(**(i.__dict__)) for i in session.query(CategoryTable).all()
+        ]
+    )
 
 
 @bibler.get("/")
@@ -1,18 +1,29 @@
 import logging
+import re
+from enum import Enum
 from typing import Optional
 
 import sqlalchemy
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Query, Response
+from sqlalchemy.sql import functions
 
-from ..dataclasses.Book import Book, BookTable
+from ..dataclasses.Book import (BOOK_RESPONSE_COLUMNS, Book, BookTable,
+                               normalize_isbn)
 from ..dataclasses.BorrowingUser import BorrowingUserTable
-from ..db.repository import Session
+from ..dataclasses.User import UserTable
+from ..db.query_cache import BOOKS, LOANS, query_cache
+from ..db.repository import get_session
+from ..responses.BookLookupResponse import (BookLookupResponseModel,
+                                            BookLookupResponseStatus)
 from ..responses.DeleteBookResponse import (DeleteBookResponseModel,
                                             DeleteBookResponseStatus)
 from ..responses.PatchBookResponse import (PatchBookResponseModel,
                                            PatchBookResponseStatus)
 from ..responses.PutBookResponse import (PutBookResponseModel,
                                          PutBookResponseStatus)
+from ..search import typeahead
+from ..stats.counters import counters
+from .fuzzy import fuzzy_search, index_books, unindex_books
 
 books = APIRouter()
 
@@ -20,53 +31,277 @@ logger = logging.getLogger("Bibler-server")
 logger.setLevel(logging.INFO)
 
 
+class BookSortKey(str, Enum):
+    """columns the book list can be sorted by"""
+    key = "key"
+    title = "title"
+    author = "author"
+    number = "number"
+    category = "category"
+
+
+SORT_COLUMNS = {
+    BookSortKey.key: BookTable.key,
+    BookSortKey.title: BookTable.title,
+    BookSortKey.author: BookTable.author,
+    BookSortKey.number: BookTable.number,
+    # books without a category are sorted as if the category was empty so
+    # that the keyset comparison never has to deal with NULL
+    BookSortKey.category: functions.coalesce(BookTable.category, ""),
+}
+# the full text index maintained by `db.migrations.create_search_index`
+books_fts = sqlalchemy.table(
+    "books_fts",
+    sqlalchemy.column("rowid"),
+    sqlalchemy.column("books_fts"),
+)
+# weights of title, author, publisher, category and isbn for the ranking
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0, 1.0, 2.0)
+SEARCH_TERM = re.compile(r"\w+")
+# ascii digits that fit into an sqlite integer, `str.isdigit` would also
+# accept digits like "²" that `int` rejects
+SHELF_NUMBER = re.compile(r"[0-9]{1,18}")
+
+
+class SearchMode(str, Enum):
+    """how `search_books` matches the query"""
+    # whole words or beginnings of words, see `fts_query`
+    fulltext = "fulltext"
+    # similar title or author, tolerates typos, see `fuzzy.fuzzy_search`
+    fuzzy = "fuzzy"
+
+
+def fts_query(text: str) -> str:
+    """turns user input into a fts5 query that matches books containing
+    all words of `text`, the words may be the beginning of a longer word"""
+    return " ".join(f'"{i}"*' for i in SEARCH_TERM.findall(text))
+
+
 @books.get("/")
-async def get_books(user_key: Optional[int] = None):
+def get_books(
+    response: Response,
+    user_key: Optional[int] = None,
+    after_key: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    sort_by: BookSortKey = BookSortKey.key,
+    title: Optional[str] = None,
+    author: Optional[str] = None,
+    category: Optional[str] = None,
+    session=Depends(get_session),
+):
     """returns a list of all books or if `user_key` is specified all 
-    books borrowed by the user with the key `user_key`"""
-    session = Session()
-    ret = session.query(BookTable)
+    books borrowed by the user with the key `user_key`
+
+    The list can be narrowed down with the `title`, `author` (both substring
+    matches) and `category` filters. If `limit` is given only one page is
+    returned: the page starts after the book with the key `after_key` in the
+    order given by `sort_by`. The total number of matching books is returned
+    in the `X-Total-Count` header and the `after_key` for the next page in
+    the `X-Next-After-Key` header."""
+    page, headers = query_cache.get(
+        ("books", user_key, after_key, limit, sort_by, title, author, category),
+        (BOOKS, LOANS),
+        lambda: query_books(
+            session, user_key, after_key, limit, sort_by, title, author, category)
+    )
+    response.headers.update(headers)
+    return page
+
+
+def query_books(session, user_key, after_key, limit, sort_by, title, author, category):
+    """returns a page of books as described in `get_books` and its headers"""
+    headers = {}
+    ret = session.query(*BOOK_RESPONSE_COLUMNS)
     if user_key is not None:
         ret = ret.join(BorrowingUserTable).filter(
             BorrowingUserTable.user_key == user_key
         ).filter(
             BorrowingUserTable.return_date == None
         )
-    return ret.all()
+    if title is not None:
+        ret = ret.filter(BookTable.title.contains(title))
+    if author is not None:
+        ret = ret.filter(BookTable.author.contains(author))
+    if category is not None:
+        ret = ret.filter(BookTable.category == category)
+    sort_column = SORT_COLUMNS[sort_by]
+    if limit is not None:
+        headers["X-Total-Count"] = str(
+            ret.with_entities(functions.count(BookTable.key)).scalar()
+        )
+    if after_key is not None:
+        if sort_by == BookSortKey.key:
+            ret = ret.filter(BookTable.key > after_key)
+        else:
+            after_value = session.query(sort_column).filter(
+                BookTable.key == after_key
+            ).as_scalar()
+            ret = ret.filter(
+                sqlalchemy.or_(
+                    sort_column > after_value,
+                    sqlalchemy.and_(
+                        sort_column == after_value,
+                        BookTable.key > after_key
+                    )
+                )
+            )
+    if sort_by == BookSortKey.key:
+        ret = ret.order_by(BookTable.key)
+    else:
+        ret = ret.order_by(sort_column, BookTable.key)
+    if limit is not None:
+        ret = ret.limit(limit)
+    page = [i._asdict() for i in ret.all()]
+    if limit is not None and len(page) == limit:
+        headers["X-Next-After-Key"] = str(page[-1]["key"])
+    return page, headers
+
+
+@books.get("/search")
+def search_books(
+    response: Response,
+    q: str,
+    limit: int = Query(20, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    mode: SearchMode = SearchMode.fulltext,
+    min_score: float = Query(0.5, gt=0, le=1),
+    session=Depends(get_session),
+):
+    """returns the books that contain all words of `q` in their title,
+    author, publisher, category or isbn, the best matches first. Returns
+    `limit` books starting at `offset`, the total number of matches is
+    returned in the `X-Total-Count` header.
+
+    With `mode` fuzzy the books whose title and author share at least
+    `min_score` of the trigrams of `q` are returned instead, ordered by
+    that share which is returned as `score`"""
+    if mode == SearchMode.fuzzy:
+        matches = fuzzy_search(session, q, min_score)
+        if matches is None:
+            response.headers["X-Total-Count"] = "0"
+            return []
+        response.headers["X-Total-Count"] = str(matches.count())
+        return [i._asdict() for i in matches.limit(limit).offset(offset)]
+    query = fts_query(q)
+    if not query:
+        response.headers["X-Total-Count"] = "0"
+        return []
+    matches = session.query(*BOOK_RESPONSE_COLUMNS).join(
+        books_fts, books_fts.c.rowid == BookTable.key
+    ).filter(
+        books_fts.c.books_fts.op("MATCH")(query)
+    )
+    response.headers["X-Total-Count"] = str(
+        matches.with_entities(functions.count(BookTable.key)).scalar()
+    )
+    rank = functions.func.bm25(
+        sqlalchemy.literal_column("books_fts"), *SEARCH_WEIGHTS)
+    return [
+        i._asdict()
+        for i in matches.order_by(rank, BookTable.key).limit(limit).offset(offset)
+    ]
+
+
+@books.get("/lookup/{code}", response_model=BookLookupResponseModel)
+def lookup_book(code: str, session=Depends(get_session)):
+    """returns the book with the scanned `code`, either its ISBN-10 or
+    ISBN-13 with or without hyphens or its shelf number, together with its
+    current loan in one query. An ISBN is preferred over a number"""
+    isbn = normalize_isbn(code) or ""
+    condition = BookTable.isbn_normalized == isbn
+    if SHELF_NUMBER.fullmatch(code.strip()):
+        condition = sqlalchemy.or_(
+            condition, BookTable.number == int(code.strip()))
+    book = session.query(
+        BookTable.key,
+        BookTable.title,
+        BookTable.author,
+        BookTable.publisher,
+        BookTable.number,
+        BookTable.shorthand,
+        BookTable.category,
+        BookTable.isbn,
+        BorrowingUserTable.user_key,
+        UserTable.firstname,
+        UserTable.lastname,
+        UserTable.classname,
+        BorrowingUserTable.start_date,
+        BorrowingUserTable.expiration_date,
+    ).outerjoin(
+        BorrowingUserTable,
+        sqlalchemy.and_(
+            BorrowingUserTable.book_key == BookTable.key,
+            BorrowingUserTable.return_date == None
+        )
+    ).outerjoin(
+        UserTable,
+        UserTable.key == BorrowingUserTable.user_key
+    ).filter(
+        condition
+    ).order_by(
+        (BookTable.isbn_normalized == isbn).desc(), BookTable.key
+    ).first()
+    if book is None:
+        return {"status": BookLookupResponseStatus.book_unknown}
+    if book.user_key is None:
+        return {"status": BookLookupResponseStatus.available, **book._asdict()}
+    return {"status": BookLookupResponseStatus.borrowed, **book._asdict()}
+
+
+@books.get("/typeahead")
+def typeahead_books(q: str, limit: int = Query(10, ge=1, le=100)):
+    """returns key, title, author and number of up to `limit` books with a
+    word in their title or author starting with every word of `q`"""
+    return typeahead.books_typeahead.search(q, limit)
 
 
 @books.get("/available")
-async def get_available_books():
+def get_available_books(session=Depends(get_session)):
     """returns a list of all availabled books that are not borrowed by anyone"""
-    session = Session()
-    ret = session.query(BookTable).filter(
-        ~BookTable.key.in_(
-            session.query(BorrowingUserTable.book_key).filter(
-                BorrowingUserTable.return_date == None
-            ).subquery()
-        )
-    ).all()
-    return ret
+    return query_cache.get(
+        ("available_books",),
+        (BOOKS, LOANS),
+        lambda: [
+            i._asdict()
+            for i in session.query(*BOOK_RESPONSE_COLUMNS).filter(
+                ~BookTable.key.in_(
+                    session.query(BorrowingUserTable.book_key).filter(
+                        BorrowingUserTable.return_date == None
+                    ).subquery()
+                )
+            )
+        ]
+    )
 
 
 @books.put("/", response_model=PutBookResponseModel)
-async def put_book(book: Book):
+def put_book(book: Book, session=Depends(get_session)):
     """inserts a new `book` into the list of existing books"""
     try:
-        session = Session()
-        ret = session.add(BookTable(book))
+        new_book = BookTable(book)
+        session.add(new_book)
+        session.flush()
+        index_books(
+            session, [(new_book.key, new_book.title, new_book.author)])
         session.commit()
     except sqlalchemy.exc.IntegrityError:
+        session.rollback()
         return {"status": PutBookResponseStatus.fail}
+    counters.books_added()
+    typeahead.add_books([new_book])
+    query_cache.invalidate(BOOKS)
     return {"status": PutBookResponseStatus.success}
 
 
 @books.patch("/", response_model=PatchBookResponseModel)
-async def patch_book(book: Book):
+def patch_book(book: Book, session=Depends(get_session)):
     """Updates an existing `book` in the list of existing books"""
     try:
-        session = Session()
-        selected_book = session.query(BookTable.key == book.key)
+        selected_book = session.query(BookTable).filter(
+            BookTable.key == book.key
+        ).first()
+        if selected_book is None:
+            return {"status": PatchBookResponseStatus.fail}
         selected_book.title = book.title
         selected_book.author = book.author
         selected_book.category = book.category
@@ -74,19 +309,24 @@ async def patch_book(book: Book):
         selected_book.number = book.number
         selected_book.publisher = book.publisher
         selected_book.isbn = book.isbn
+        selected_book.isbn_normalized = normalize_isbn(book.isbn)
+        index_books(
+            session, [(selected_book.key, selected_book.title, selected_book.author)])
         session.commit()
     except sqlalchemy.exc.IntegrityError:
+        session.rollback()
         return {"status": PatchBookResponseStatus.fail}
+    typeahead.add_books([selected_book])
+    query_cache.invalidate(BOOKS)
     return {"status": PatchBookResponseStatus.success}
 
 
 @books.delete("/{book_key}", response_model=DeleteBookResponseModel)
-async def patch_book(book_key: int):
+def delete_book(book_key: int, session=Depends(get_session)):
     """Delete an existing book with the key `book_key` in the list of existing books"""
     try:
-        session = Session()
         if session.query(BorrowingUserTable).filter(
-            BorrowingUserTable.return_date != None,
+            BorrowingUserTable.return_date == None,
             BorrowingUserTable.book_key == book_key
         ).first() is not None:
             return {"status": DeleteBookResponseStatus.borrowed}
@@ -94,18 +334,24 @@ async def patch_book(book_key: int):
             BookTable
         ).filter(
             BookTable.key == book_key
-        )
+        ).first()
+        if selected_book is None:
+            return {"status": DeleteBookResponseStatus.fail}
+        unindex_books(session, [book_key])
         session.delete(selected_book)
         session.commit()
     except sqlalchemy.exc.IntegrityError:
+        session.rollback()
         return {"status": DeleteBookResponseStatus.fail}
+    counters.books_removed()
+    typeahead.books_typeahead.remove(book_key)
+    query_cache.invalidate(BOOKS)
     return {"status": DeleteBookResponseStatus.success}
 
 
 @books.get("/borrowed/{book_key}", response_model=str)
-async def is_borrowed(book_key: int):
+def is_borrowed(book_key: int, session=Depends(get_session)):
     """check weather a book with the key `book_key` is currently borrowed by anyone"""
-    session = Session()
     borrowed_state = session.query(BorrowingUserTable).filter(
         BorrowingUserTable.book_key == book_key,
         BorrowingUserTable.return_date == None
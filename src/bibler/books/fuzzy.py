@@ -0,0 +1,145 @@
+import logging
+import re
+import unicodedata
+from typing import Iterable, List, Set, Tuple
+
+from sqlalchemy.sql import functions
+
+from ..dataclasses.Book import BOOK_RESPONSE_COLUMNS, BookTable
+from ..dataclasses.BookTrigram import BookTrigramTable
+from ..db.repository import chunks
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+WORD = re.compile(r"\w+")
+# longer queries are cut, they would only add trigrams but no precision
+MAX_QUERY_LENGTH = 100
+INSERT_TRIGRAM = (
+    f"INSERT INTO {BookTrigramTable.__tablename__} (trigram, book_key) "
+    "VALUES (?, ?)"
+)
+
+
+def fold(text: str) -> str:
+    """lowercases `text` and removes all diacritics, so "Bartimäus" and
+    "Bartimaus" or "Straße" and "strasse" become the same"""
+    if text.isascii():
+        # nothing to decompose, this spares most titles the loop below
+        return text.lower()
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(i for i in text if not unicodedata.combining(i))
+
+
+def trigrams(text: str) -> Set[str]:
+    """returns the trigrams of all words of the folded `text`. Words are
+    padded with two spaces in front and one at the end, so that the
+    beginning of a word weighs more and single letters like initials still
+    have trigrams"""
+    result = set()
+    for word in WORD.findall(fold(text or "")):
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def book_trigrams(title: str, author: str) -> Set[str]:
+    """returns the trigrams a book is found by"""
+    return trigrams(title) | trigrams(author)
+
+
+def index_books(session, books: Iterable[Tuple[int, str, str]]):
+    """replaces the trigrams of `books`, tuples of key, title and author,
+    with one executemany. Must run in the transaction that writes the
+    books"""
+    books = list(books)
+    unindex_books(session, [key for key, _, _ in books])
+    rows = [
+        (trigram, key)
+        for key, title, author in books
+        for trigram in book_trigrams(title, author)
+    ]
+    if not rows:
+        return
+    # the rows go straight to sqlite, building the parameters of hundreds
+    # of thousands of rows in sqlalchemy takes longer than inserting them
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.executemany(INSERT_TRIGRAM, rows)
+    finally:
+        cursor.close()
+
+
+def index_books_by_number(session, numbers: Iterable[int]):
+    """indexes the books with the given `numbers`, e.g. after an import
+    that inserted them without returning their keys. Returns the key,
+    title, author and number of the indexed books"""
+    books = [
+        row
+        for chunk in chunks(list(numbers))
+        for row in session.query(
+            BookTable.key, BookTable.title, BookTable.author, BookTable.number
+        ).filter(
+            BookTable.number.in_(chunk)
+        )
+    ]
+    index_books(session, [(i.key, i.title, i.author) for i in books])
+    return books
+
+
+def unindex_books(session, book_keys: List[int]):
+    """removes the trigrams of the books with the keys `book_keys`"""
+    for chunk in chunks(book_keys):
+        session.query(BookTrigramTable).filter(
+            BookTrigramTable.book_key.in_(chunk)
+        ).delete(synchronize_session=False)
+
+
+def rebuild_trigrams(session):
+    """indexes all books again"""
+    session.query(BookTrigramTable).delete(synchronize_session=False)
+    books = session.query(BookTable.key, BookTable.title, BookTable.author)
+    batch = []
+    for book in books.yield_per(1000):
+        batch.append(book)
+        if len(batch) == 1000:
+            index_books(session, batch)
+            batch = []
+    index_books(session, batch)
+    logger.info("rebuilt the trigrams of all books")
+
+
+def trigrams_missing(session) -> bool:
+    """checks whether there are books but no trigrams yet"""
+    return (
+        session.query(BookTrigramTable).first() is None
+        and session.query(BookTable).first() is not None
+    )
+
+
+def fuzzy_search(session, text: str, min_score: float):
+    """returns a query of the books sharing at least `min_score` of the
+    trigrams of `text` and a column with that share, the best matches
+    first. Only the trigrams of `text` are looked up in the index, the
+    books are never scanned. Returns None if `text` has no trigrams"""
+    query_trigrams = trigrams(text[:MAX_QUERY_LENGTH])
+    if not query_trigrams:
+        return None
+    hits = functions.count(BookTrigramTable.trigram)
+    candidates = session.query(
+        BookTrigramTable.book_key,
+        (hits * 1.0 / len(query_trigrams)).label("score"),
+    ).filter(
+        BookTrigramTable.trigram.in_(query_trigrams)
+    ).group_by(
+        BookTrigramTable.book_key
+    ).having(
+        hits >= min_score * len(query_trigrams)
+    ).subquery()
+    return session.query(
+        *BOOK_RESPONSE_COLUMNS, candidates.c.score
+    ).join(
+        candidates, candidates.c.book_key == BookTable.key
+    ).order_by(
+        candidates.c.score.desc(), BookTable.key
+    )
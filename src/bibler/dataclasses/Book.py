@@ -1,3 +1,4 @@
+import re
 from typing import Optional
 
 import sqlalchemy
@@ -21,17 +22,35 @@ class Book(BaseModel):
     media: Optional[Media] = None
 
 
+def normalize_isbn(isbn: Optional[str]) -> Optional[str]:
+    """returns `isbn` without separators and as ISBN-13 if it is an ISBN-10,
+    so that both forms of an ISBN are found by the same value. Values that
+    are no ISBN are only stripped of separators"""
+    if isbn is None:
+        return None
+    isbn = re.sub(r"[^0-9Xx]", "", isbn).upper()
+    if re.fullmatch(r"\d{9}[\dX]", isbn):
+        digits = "978" + isbn[:9]
+        check = sum(
+            int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+        return digits + str((10 - check % 10) % 10)
+    return isbn or None
+
+
 class BookTable(Base):
     __tablename__ = "books"
     key = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-    title = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    title = sqlalchemy.Column(sqlalchemy.String, nullable=False, index=True)
     category = sqlalchemy.Column(sqlalchemy.String,
-                                 ForeignKey(f"{CategoryTable.__tablename__}.name"))
-    author = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+                                 ForeignKey(f"{CategoryTable.__tablename__}.name"),
+                                 index=True)
+    author = sqlalchemy.Column(sqlalchemy.String, nullable=False, index=True)
     publisher = sqlalchemy.Column(sqlalchemy.String, nullable=False)
     number = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, unique=True)
     shorthand = sqlalchemy.Column(sqlalchemy.String, nullable=False)
     isbn = sqlalchemy.Column(sqlalchemy.String)
+    # `isbn` as returned by `normalize_isbn`, the scanner lookup uses it
+    isbn_normalized = sqlalchemy.Column(sqlalchemy.String, index=True)
 
     def __init__(self, book: Book):
         self.title = book.title
@@ -41,7 +60,14 @@ class BookTable(Base):
         self.shorthand = book.shorthand
         self.category = book.category
         self.isbn = book.isbn
+        self.isbn_normalized = normalize_isbn(book.isbn)
 
     def __repr__(self):
         return f"Book<{self.key}, {self.title}, {self.author}, {self.publisher}, \
             {self.category}, {self.number}, {self.shorthand}, {self.shorthand}>"
+
+
+# the columns of a book the api returns, `isbn_normalized` is internal
+BOOK_RESPONSE_COLUMNS = [
+    i for i in BookTable.__table__.columns if i.key != "isbn_normalized"
+]
@@ -0,0 +1,23 @@
+import sqlalchemy
+from sqlalchemy.sql.schema import ForeignKey
+
+from .Book import BookTable
+from .model import Base
+
+
+class BookTrigramTable(Base):
+    """trigrams of the folded title and author of every book, the index of
+    the fuzzy search"""
+    __tablename__ = "book_trigrams"
+    __table_args__ = (
+        sqlalchemy.Index("ix_book_trigrams_book_key", "book_key"),
+    )
+    trigram = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    book_key = sqlalchemy.Column(
+        sqlalchemy.Integer,
+        ForeignKey(f"{BookTable.__tablename__}.key"),
+        primary_key=True
+    )
+
+    def __repr__(self):
+        return f"BookTrigram<{self.trigram}, {self.book_key}>"
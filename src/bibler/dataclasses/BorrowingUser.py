@@ -17,10 +17,39 @@ class BorrowingUser(BaseModel):
     start_date: date
     expiration_date: date
     return_date: Optional[date]
+    category: Optional[str] = None
+    classname: Optional[str] = None
+
+
+class BorrowingRequest(BaseModel):
+    user_key: int
+    book_key: int
 
 
 class BorrowingUserTable(Base):
     __tablename__ = "borrowing_users"
+    # almost every lookup is only interested in the loans that are still
+    # open, so the indexes only cover those (partial indexes on sqlite).
+    # A book can only be borrowed once at a time, which the unique index
+    # enforces even for concurrent requests
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ux_borrowing_users_open_book_key",
+            "book_key",
+            unique=True,
+            sqlite_where=sqlalchemy.text("return_date IS NULL")
+        ),
+        sqlalchemy.Index(
+            "ix_borrowing_users_open_user_key",
+            "user_key",
+            sqlite_where=sqlalchemy.text("return_date IS NULL")
+        ),
+        sqlalchemy.Index(
+            "ix_borrowing_users_open_expiration_date",
+            "expiration_date",
+            sqlite_where=sqlalchemy.text("return_date IS NULL")
+        ),
+    )
     key = sqlalchemy.Column(
         sqlalchemy.Integer, primary_key=True)
     user_key = sqlalchemy.Column(sqlalchemy.Integer, ForeignKey(
@@ -30,6 +59,12 @@ class BorrowingUserTable(Base):
     start_date = sqlalchemy.Column(sqlalchemy.Date, nullable=False)
     expiration_date = sqlalchemy.Column(sqlalchemy.Date, nullable=False)
     return_date = sqlalchemy.Column(sqlalchemy.Date)
+    # category of the book and class of the user when the loan started,
+    # "" if they had none. The rollups of a loan stay in the same group
+    # even if the book or the user is changed before it is returned. NULL
+    # for loans recorded before these columns existed
+    category = sqlalchemy.Column(sqlalchemy.String)
+    classname = sqlalchemy.Column(sqlalchemy.String)
 
     def __init__(self, borrowing_user: BorrowingUser):
         self.user_key = borrowing_user.user_key
@@ -37,6 +72,8 @@ class BorrowingUserTable(Base):
         self.start_date = borrowing_user.start_date
         self.expiration_date = borrowing_user.expiration_date
         self.return_date = borrowing_user.return_date
+        self.category = borrowing_user.category
+        self.classname = borrowing_user.classname
 
     def __repr__(self):
         return f"BorrowingUser<{self.key}, {self.book_key}, {self.user_key}, \
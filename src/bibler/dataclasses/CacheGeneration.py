@@ -0,0 +1,16 @@
+import sqlalchemy
+
+from .model import Base
+
+
+class CacheGenerationTable(Base):
+    """generation of every tag of the query cache and of the statistics
+    counters. It is stored in the database so that an invalidation by one
+    worker process is seen by the caches of all other workers"""
+    __tablename__ = "cache_generations"
+    tag = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    generation = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"CacheGeneration<{self.tag}, {self.generation}>"
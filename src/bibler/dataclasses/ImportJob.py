@@ -0,0 +1,32 @@
+import sqlalchemy
+
+from .model import Base
+
+
+class ImportJobTable(Base):
+    """state of a background import. It is stored in the database so that
+    an import can be polled from every worker process, not only from the
+    one running it"""
+    __tablename__ = "import_jobs"
+    job_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    kind = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    status = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    created = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False, index=True)
+    finished = sqlalchemy.Column(sqlalchemy.DateTime)
+    rows_parsed = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    rows_inserted = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    rows_updated = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    rows_unchanged = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    duplicates_skipped = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    rows_invalid = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    # json list of the error messages
+    errors = sqlalchemy.Column(sqlalchemy.Text, nullable=False, default="[]")
+
+    def __repr__(self):
+        return f"ImportJob<{self.job_id}, {self.kind}, {self.status}>"
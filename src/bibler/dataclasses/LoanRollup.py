@@ -0,0 +1,51 @@
+from datetime import date
+
+import sqlalchemy
+from pydantic import BaseModel
+
+from .model import Base
+
+
+class LoanRollup(BaseModel):
+    day: date
+    category: str
+    classname: str
+    started: int
+    returned: int
+    due: int
+    returned_in_time: int
+
+
+class LoanRollupTable(Base):
+    """daily aggregates of the borrowing history per category and class.
+    Books without category and users without class are aggregated under the
+    empty string so that every row has a complete primary key"""
+    __tablename__ = "loan_rollups"
+    day = sqlalchemy.Column(sqlalchemy.Date, primary_key=True)
+    category = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    classname = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    # loans started on `day`
+    started = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    # loans returned on `day`
+    returned = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    # loans whose (possibly extended) expiration date is `day`
+    due = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+    # loans due on `day` that were returned on or before `day`
+    returned_in_time = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+
+    def __init__(self, rollup: LoanRollup):
+        self.day = rollup.day
+        self.category = rollup.category
+        self.classname = rollup.classname
+        self.started = rollup.started
+        self.returned = rollup.returned
+        self.due = rollup.due
+        self.returned_in_time = rollup.returned_in_time
+
+    def __repr__(self):
+        return f"LoanRollup<{self.day}, {self.category}, {self.classname}, \
+            {self.started}, {self.returned}, {self.due}, {self.returned_in_time}>"
@@ -0,0 +1,196 @@
+import logging
+
+import sqlalchemy
+
+from ..dataclasses.Book import BookTable, normalize_isbn
+from ..dataclasses.BorrowingUser import BorrowingUserTable
+from ..dataclasses.User import UserTable
+from ..dataclasses.model import Base
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+# indexes that were replaced by an index with a different definition
+OBSOLETE_INDEXES = [
+    "ix_borrowing_users_open_book_key",
+]
+# columns of the books that are searched by the full text index
+SEARCH_COLUMNS = ["title", "author", "publisher", "category", "isbn"]
+
+
+def add_missing_columns(engine):
+    """adds the columns declared on the tables that are missing in the
+    database. sqlite can only add nullable columns without constraints,
+    which is all new columns may be"""
+    inspector = sqlalchemy.inspect(engine)
+    tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {i["name"] for i in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    logger.info(f"adding column {table.name}.{column.name}")
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+
+
+def backfill_isbn_normalized(engine):
+    """normalizes the isbns of books stored before `isbn_normalized` existed"""
+    table = BookTable.__table__
+    with engine.begin() as connection:
+        rows = connection.execute(
+            sqlalchemy.select([table.c.key, table.c.isbn]).where(
+                sqlalchemy.and_(
+                    table.c.isbn != None,
+                    table.c.isbn_normalized == None
+                )
+            )
+        ).fetchall()
+        if rows:
+            logger.info(f"normalizing {len(rows)} isbns")
+            connection.execute(
+                table.update().where(
+                    table.c.key == sqlalchemy.bindparam("book_key")
+                ).values(isbn_normalized=sqlalchemy.bindparam("normalized")),
+                [
+                    {"book_key": key, "normalized": normalize_isbn(isbn)}
+                    for key, isbn in rows
+                ]
+            )
+
+
+def backfill_loan_groups(engine):
+    """records the current category of the book and class of the user on
+    the loans stored before `BorrowingUserTable` kept them"""
+    loans = BorrowingUserTable.__table__
+    with engine.begin() as connection:
+        for column, value in [
+            ("category", sqlalchemy.select([BookTable.category]).where(
+                BookTable.key == loans.c.book_key)),
+            ("classname", sqlalchemy.select([UserTable.classname]).where(
+                UserTable.key == loans.c.user_key)),
+        ]:
+            updated = connection.execute(
+                loans.update().where(
+                    loans.c[column] == None
+                ).values({
+                    column: sqlalchemy.func.coalesce(value.as_scalar(), "")
+                })
+            ).rowcount
+            if updated:
+                logger.info(f"recorded the {column} of {updated} loans")
+
+
+def close_duplicate_open_loans(engine):
+    """closes all but the newest open loan of every book, older databases
+    did not prevent a book from being borrowed twice. The older loans are
+    closed on the day the newest one started, the day the book evidently
+    changed hands"""
+    loans = BorrowingUserTable.__table__
+    newest = loans.alias("newest")
+    open_loans_of_book = sqlalchemy.and_(
+        newest.c.book_key == loans.c.book_key,
+        newest.c.return_date == None
+    )
+    with engine.begin() as connection:
+        closed = connection.execute(
+            loans.update().where(
+                sqlalchemy.and_(
+                    loans.c.return_date == None,
+                    loans.c.key < sqlalchemy.select([
+                        sqlalchemy.func.max(newest.c.key)
+                    ]).where(open_loans_of_book).as_scalar()
+                )
+            ).values(
+                return_date=sqlalchemy.select([newest.c.start_date]).where(
+                    open_loans_of_book
+                ).order_by(newest.c.key.desc()).limit(1).as_scalar()
+            )
+        ).rowcount
+        if closed:
+            logger.warning(f"closed {closed} duplicate open loans")
+
+
+def create_missing_indexes(engine):
+    """creates all indexes declared on the tables that are missing in the
+    database, e.g. because it was created by an older version of bibler"""
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"creating index {index.name}")
+                try:
+                    index.create(engine)
+                except sqlalchemy.exc.IntegrityError:
+                    # refuse to start instead of running without the
+                    # constraint the code relies on
+                    logger.error(
+                        f"index {index.name} can not be created because the "
+                        f"database violates it, fix the data and restart"
+                    )
+                    raise
+
+
+def drop_obsolete_indexes(engine):
+    """drops indexes that have been replaced"""
+    with engine.connect() as connection:
+        for name in OBSOLETE_INDEXES:
+            connection.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_search_index(engine):
+    """creates the full text index `books_fts` over the books and the
+    triggers that keep it in sync with every insert, update and delete, no
+    matter if it comes from the api or an import. The index is filled from
+    the existing books when it is created"""
+    columns = ", ".join(SEARCH_COLUMNS)
+    new_values = ", ".join(f"new.{i}" for i in SEARCH_COLUMNS)
+    old_values = ", ".join(f"old.{i}" for i in SEARCH_COLUMNS)
+    with engine.begin() as connection:
+        exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+        ).first() is not None
+        if not exists:
+            logger.info("creating full text index books_fts")
+            connection.execute(f"""
+                CREATE VIRTUAL TABLE books_fts USING fts5(
+                    {columns},
+                    content='books',
+                    content_rowid='key',
+                    tokenize='unicode61 remove_diacritics 2'
+                )""")
+        connection.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+                INSERT INTO books_fts(rowid, {columns})
+                VALUES (new.key, {new_values});
+            END""")
+        connection.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+                INSERT INTO books_fts(books_fts, rowid, {columns})
+                VALUES ('delete', old.key, {old_values});
+            END""")
+        connection.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE ON books BEGIN
+                INSERT INTO books_fts(books_fts, rowid, {columns})
+                VALUES ('delete', old.key, {old_values});
+                INSERT INTO books_fts(rowid, {columns})
+                VALUES (new.key, {new_values});
+            END""")
+        if not exists:
+            connection.execute(
+                "INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+
+
+def migrate(engine):
+    """brings the schema of an existing database up to date"""
+    drop_obsolete_indexes(engine)
+    add_missing_columns(engine)
+    backfill_isbn_normalized(engine)
+    backfill_loan_groups(engine)
+    close_duplicate_open_loans(engine)
+    create_missing_indexes(engine)
+    create_search_index(engine)
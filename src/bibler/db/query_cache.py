@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable
+
+import sqlalchemy
+
+from ..configuration import default_conf
+from ..dataclasses.CacheGeneration import CacheGenerationTable
+from .repository import engine
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+# tags of the data a cached result depends on, writes invalidate them
+BOOKS = "books"
+USERS = "users"
+LOANS = "loans"
+CATEGORIES = "categories"
+# sqlite upsert, sqlalchemy 1.3 has no construct for it
+INCREMENT_GENERATION = sqlalchemy.text(f"""
+    INSERT INTO {CacheGenerationTable.__tablename__} (tag, generation)
+    VALUES (:tag, 1)
+    ON CONFLICT (tag) DO UPDATE SET generation = generation + 1""")
+
+
+class QueryCache:
+    """read through cache of query results. Holds at most `max_entries`
+    results for at most `ttl` seconds, evicting the least recently used
+    first. Every result is stored with the tags of the tables it was read
+    from and is dropped as soon as one of them is invalidated by a write.
+
+    Every tag has a generation in the database that is increased on
+    invalidation, so a write in one worker process invalidates the results
+    cached by all workers. A result is stored with the generations read
+    before it was computed and only served while they are unchanged, so a
+    write that commits during a read can not leave a stale result behind"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (expiry, tags, generations, value)
+        self.entries = OrderedDict()
+        self.metrics = Counter()
+
+    def generations(self, tags: Iterable[str]) -> Dict[str, int]:
+        """returns the current generations of `tags`, tags that were never
+        invalidated have the generation 0"""
+        table = CacheGenerationTable.__table__
+        with engine.connect() as connection:
+            stored = dict(connection.execute(
+                sqlalchemy.select([table.c.tag, table.c.generation]).where(
+                    table.c.tag.in_(tags))
+            ).fetchall())
+        return {i: stored.get(i, 0) for i in tags}
+
+    def get(self, key: Hashable, tags: Iterable[str], compute: Callable[[], Any]) -> Any:
+        """returns the cached result for `key` or computes and caches it"""
+        tags = tuple(tags)
+        generations = self.generations(tags)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expiry, _, entry_generations, value = entry
+                if expiry > time.monotonic() and entry_generations == generations:
+                    self.entries.move_to_end(key)
+                    self.metrics["hits"] += 1
+                    return value
+                del self.entries[key]
+                if expiry > time.monotonic():
+                    # invalidated by another worker
+                    self.metrics["invalidations"] += 1
+                else:
+                    self.metrics["expired"] += 1
+            self.metrics["misses"] += 1
+        value = compute()
+        with self.lock:
+            self.entries[key] = (
+                time.monotonic() + self.ttl, tags, generations, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+        return value
+
+    def invalidate(self, *tags: str):
+        """drops all results that depend on any of `tags`, call it after
+        the write to them has been committed"""
+        with engine.begin() as connection:
+            for tag in tags:
+                connection.execute(INCREMENT_GENERATION, tag=tag)
+        with self.lock:
+            stale = [
+                key for key, (_, entry_tags, _, _) in self.entries.items()
+                if any(i in entry_tags for i in tags)
+            ]
+            for key in stale:
+                del self.entries[key]
+            self.metrics["invalidations"] += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_metrics(self):
+        """returns the counters of the cache"""
+        with self.lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.metrics["hits"],
+                "misses": self.metrics["misses"],
+                "hit_ratio": self.metrics["hits"] / lookups if lookups else 0.0,
+                "expired": self.metrics["expired"],
+                "evictions": self.metrics["evictions"],
+                "invalidations": self.metrics["invalidations"],
+            }
+
+
+query_cache = QueryCache(
+    default_conf.getint("query_cache_size", 256),
+    default_conf.getfloat("query_cache_ttl", 300),
+)
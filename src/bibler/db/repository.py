@@ -1,23 +1,132 @@
 
 import logging
 import os
+from contextlib import contextmanager
+from typing import Any, List
 
 import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from ..configuration import default_conf
+from ..dataclasses.BookTrigram import BookTrigramTable
+from ..dataclasses.CacheGeneration import CacheGenerationTable
+from ..dataclasses.ImportJob import ImportJobTable
+from ..dataclasses.LoanRollup import LoanRollupTable
 from ..dataclasses.model import Base
+from .migrations import migrate
 
 logging.info(f"{[i for i in default_conf]}")
 DB_PREFIX = "sqlite:///"
 DB_URL = "data/bibler.db"
+# sqlite limits the number of bound parameters of a statement
+MAX_IN_PARAMETERS = 500
 if os.path.exists(DB_URL) and default_conf["production"] == "false":
     logging.warn("Removing existing database")
     os.remove(DB_URL)
+    for journal in (f"{DB_URL}-wal", f"{DB_URL}-shm"):
+        if os.path.exists(journal):
+            os.remove(journal)
+
+# pragmas applied to every new connection. The production profile trades
+# durability of the very last commits on power loss (synchronous=NORMAL)
+# for not having to fsync on every commit, and uses the write ahead log so
+# readers never block the writer and vice versa
+STORAGE_PROFILES = {
+    "development": {
+        "echo": True,
+        "pragmas": {},
+    },
+    "production": {
+        "echo": False,
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 268435456,
+            "cache_size": -65536,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+    },
+}
+storage_profile = STORAGE_PROFILES[default_conf.get(
+    "storage_profile",
+    "production" if default_conf["production"] == "true" else "development"
+)]
+# single pragmas can be overridden with `sqlite_<pragma>` in bibler.ini
+pragmas = {
+    **storage_profile["pragmas"],
+    **{
+        key[len("sqlite_"):]: value
+        for key, value in default_conf.items()
+        if key.startswith("sqlite_")
+    },
+}
+
 engine = sqlalchemy.create_engine(
     f"{DB_PREFIX}{DB_URL}",
-    echo=True,
-    connect_args={"check_same_thread": False}
+    echo=default_conf.getboolean("echo", storage_profile["echo"]),
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=default_conf.getint("db_pool_size", 5),
+    max_overflow=default_conf.getint("db_max_overflow", 10),
+    pool_timeout=default_conf.getint("db_pool_timeout", 30),
 )
+
+
+@event.listens_for(engine, "connect")
+def apply_pragmas(dbapi_connection, connection_record):
+    """applies the pragmas of the selected storage profile to a new connection"""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
 Session = sessionmaker(bind=engine)
+# `BookTrigramTable`, `CacheGenerationTable` and `LoanRollupTable` are
+# imported above so that they are registered on `Base` even though no
+# router imports them before this module
 Base.metadata.create_all(engine)
+migrate(engine)
+
+
+@contextmanager
+def session_scope():
+    """provides a `Session` that is committed when the block finishes,
+    rolled back if the block raises and closed in any case"""
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_session():
+    """FastAPI dependency that yields one `Session` per request and returns
+    its connection to the pool once the response has been sent"""
+    with session_scope() as session:
+        yield session
+
+
+def get_pool_status():
+    """returns the current usage of the connection pool"""
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+
+
+def chunks(values: List[Any], size: int = MAX_IN_PARAMETERS):
+    """splits `values` into lists of at most `size` elements, e.g. to keep
+    the number of parameters of an IN clause below the limit of sqlite"""
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
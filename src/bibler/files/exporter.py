@@ -0,0 +1,159 @@
+import csv
+import io
+import json
+import logging
+from enum import Enum
+from typing import Iterator, List
+
+import sqlalchemy
+
+from ..configuration import default_conf
+from ..db.repository import session_scope
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    # the columnar formats are optional, csv and ndjson work without pyarrow
+    pyarrow = None
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+# number of rows that are fetched and encoded at once
+EXPORT_BATCH_SIZE = default_conf.getint("export_batch_size", 1000)
+# excel does not detect utf-8 in csv files
+EXPORT_CSV_ENCODING = "iso-8859-1"
+
+
+class ExportFormat(str, Enum):
+    """machine readable export formats"""
+    ndjson = "ndjson"
+    arrow = "arrow"
+    parquet = "parquet"
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.arrow: "application/vnd.apache.arrow.stream",
+    ExportFormat.parquet: "application/vnd.apache.parquet",
+}
+EXPORT_FILE_ENDINGS = {
+    ExportFormat.ndjson: ".ndjson",
+    ExportFormat.arrow: ".arrows",
+    ExportFormat.parquet: ".parquet",
+}
+
+
+def query_batches(columns: List, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List]:
+    """yields all rows of `columns` in lists of at most `batch_size` rows.
+    Uses its own session because it is consumed after the request handler
+    has returned"""
+    with session_scope() as session:
+        batch = []
+        for row in session.query(*columns).yield_per(batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def stream_csv(columns: List) -> Iterator[bytes]:
+    """yields a csv file with one column per element of `columns`, encoded
+    batch by batch, so only one batch is held in memory at once"""
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow([i.key for i in columns])
+    for batch in query_batches(columns):
+        writer.writerows(batch)
+        yield f.getvalue().encode(EXPORT_CSV_ENCODING, errors="replace")
+        f.seek(0)
+        f.truncate()
+    yield f.getvalue().encode(EXPORT_CSV_ENCODING, errors="replace")
+
+
+def stream_ndjson(columns: List) -> Iterator[bytes]:
+    """yields one json object per row with the keys of `columns`"""
+    names = [i.key for i in columns]
+    for batch in query_batches(columns):
+        yield "".join(
+            json.dumps(dict(zip(names, row)), default=str) + "\n"
+            for row in batch
+        ).encode("utf-8")
+
+
+class ChunkBuffer(io.RawIOBase):
+    """write only file object that hands out what has been written so far,
+    so the output of a pyarrow writer can be streamed piece by piece"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def take(self) -> bytes:
+        """returns and forgets everything written since the last call"""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema(columns: List):
+    """returns the arrow schema matching the sqlalchemy `columns`"""
+    types = {
+        sqlalchemy.Integer: pyarrow.int64(),
+        sqlalchemy.Date: pyarrow.date32(),
+        sqlalchemy.String: pyarrow.string(),
+    }
+    return pyarrow.schema([
+        (
+            i.key,
+            next(t for sql_type, t in types.items()
+                 if isinstance(i.type, sql_type))
+        )
+        for i in columns
+    ])
+
+
+def stream_columnar(columns: List, export_format: ExportFormat) -> Iterator[bytes]:
+    """yields an arrow ipc stream or a parquet file of `columns` with one
+    record batch or row group per batch of rows"""
+    schema = arrow_schema(columns)
+    sink = ChunkBuffer()
+    if export_format == ExportFormat.arrow:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    else:
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for batch in query_batches(columns):
+        writer.write_table(pyarrow.Table.from_batches([
+            pyarrow.RecordBatch.from_arrays(
+                [
+                    pyarrow.array(values, type=field.type)
+                    for values, field in zip(zip(*batch), schema)
+                ],
+                schema=schema
+            )
+        ]))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def stream_export(columns: List, export_format: ExportFormat) -> Iterator[bytes]:
+    """yields the export of `columns` in `export_format`"""
+    if export_format == ExportFormat.ndjson:
+        return stream_ndjson(columns)
+    return stream_columnar(columns, export_format)
@@ -1,171 +1,150 @@
 
-import csv
-import datetime
-import io
 import logging
+from datetime import datetime
 
-import numpy as np
-import pandas as pd
-from bs4.dammit import UnicodeDammit
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from fastapi.datastructures import UploadFile
 from fastapi.params import File
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.responses import StreamingResponse
 
-from ..dataclasses.Book import Book, BookTable
-from ..dataclasses.User import User, UserTable
-from ..db.repository import Session
+from ..dataclasses.Book import BookTable
+from ..dataclasses.BorrowingUser import BorrowingUserTable
+from ..dataclasses.User import UserTable
 from ..responses.ImportBooksResponse import ImportBooksResponseStatus
+from ..responses.ImportJobResponse import ImportJobResponseModel
+from .exporter import (EXPORT_FILE_ENDINGS, EXPORT_MEDIA_TYPES, ExportFormat,
+                       pyarrow, stream_csv, stream_export)
+from .importer import (ImportMode, import_books, import_users, merge_books,
+                       read_csv_chunks)
+from .jobs import get_job, submit_import
 
 files = APIRouter()
 logger = logging.getLogger("Bibler-server")
 logger.setLevel(logging.INFO)
 
 
-@files.get("/books/export/csv/", response_class=FileResponse)
-async def export_books_csv():
-    """export `Book`s to csv file"""
-    session = Session()
-    books = session.query(
-        BookTable.title,
-        BookTable.author,
-        BookTable.publisher,
-        BookTable.shorthand,
-        BookTable.number,
-        BookTable.category,
-        BookTable.isbn,
-    ).all()
-    f = io.StringIO()
-    csv_f = csv.writer(f)
-    csv_f.writerow(
-        [
-            "title",
-            "author",
-            "publisher",
-            "shorthand",
-            "number",
-            "category",
-            "isbn",
-        ]
+BOOK_EXPORT_COLUMNS = [
+    BookTable.title,
+    BookTable.author,
+    BookTable.publisher,
+    BookTable.shorthand,
+    BookTable.number,
+    BookTable.category,
+    BookTable.isbn,
+]
+USER_EXPORT_COLUMNS = [
+    UserTable.firstname,
+    UserTable.lastname,
+    UserTable.classname,
+]
+LOAN_EXPORT_COLUMNS = [
+    BorrowingUserTable.key,
+    BorrowingUserTable.book_key,
+    BorrowingUserTable.user_key,
+    BorrowingUserTable.start_date,
+    BorrowingUserTable.expiration_date,
+    BorrowingUserTable.return_date,
+]
+
+
+def export_response(columns, export_format: ExportFormat, name: str):
+    """returns a streaming download of `columns` in `export_format`"""
+    if export_format != ExportFormat.ndjson and pyarrow is None:
+        raise HTTPException(
+            status_code=501,
+            detail=f"{export_format.value} export requires pyarrow"
+        )
+    today = datetime.now().strftime("%d.%m.%Y")
+    return StreamingResponse(
+        stream_export(columns, export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={
+            "Content-Disposition": f"attachment; filename={name} {today}{EXPORT_FILE_ENDINGS[export_format]}"}
     )
-    csv_f.writerows(books)
+
+
+@files.get("/books/export/csv/", response_class=StreamingResponse)
+def export_books_csv():
+    """export `Book`s to csv file"""
     today = datetime.now().strftime("%d.%m.%Y")
     return StreamingResponse(
-        io.BytesIO(f.getvalue().encode("iso-8859-1")),
+        stream_csv(BOOK_EXPORT_COLUMNS),
         media_type="text/csv",
         headers={
-            "Content-Disposition": f"attachment; filename=Benutzerliste {today}.csv"}
+            "Content-Disposition": f"attachment; filename=Buecherliste {today}.csv"}
     )
 
 
-@files.get("/users/export/csv/", response_class=FileResponse)
-async def export_books_csv():
+@files.get("/users/export/csv/", response_class=StreamingResponse)
+def export_users_csv():
     """export `Users`s to csv file"""
-    session = Session()
-    books = session.query(
-        UserTable.firstname,
-        UserTable.lastname,
-        UserTable.classname,
-    ).all()
-    f = io.StringIO()
-    csv_f = csv.writer(f)
-    csv_f.writerow(
-        [
-            "firstname",
-            "lastname",
-            "classname",
-        ]
-    )
-    csv_f.writerows(books)
     today = datetime.now().strftime("%d.%m.%Y")
     return StreamingResponse(
-        io.BytesIO(f.getvalue().encode("iso-8859-1")),
+        stream_csv(USER_EXPORT_COLUMNS),
         media_type="text/csv",
         headers={
             "Content-Disposition": f"attachment; filename=Benutzerliste {today}.csv", }
     )
 
 
-async def import_user_csv_from_path(file):
-    """import `Users`s from csv file"""
-    session = Session()
-    df: pd.DataFrame = pd.read_csv(file).replace({np.nan: None})
-    logger.info(f"importing csv with columns:  {df.columns}")
-    logger.info(f"shape:  {df.shape}")
-    df = df[
-        (~df.firstname.isnull())
-        & (~df.lastname.isnull())
-        & (~df.classname.isnull())
-    ]
-    records = [UserTable(User(key=-1, **i))
-               for i in df.to_dict(orient="records")]
-    session.add_all(records)
-    session.commit()
-    return {"status": ImportBooksResponseStatus.success, "import_count": len(df.index)}
-
-
-@files.post("/users/import/csv/")
-async def import_user_csv(file: UploadFile = File(...)):
+@files.get("/books/export/{export_format}/", response_class=StreamingResponse)
+def export_books(export_format: ExportFormat):
+    """export `Book`s including their key as json lines, arrow ipc stream
+    or parquet file"""
+    return export_response(
+        [BookTable.key] + BOOK_EXPORT_COLUMNS, export_format, "Buecherliste")
+
+
+@files.get("/users/export/{export_format}/", response_class=StreamingResponse)
+def export_users(export_format: ExportFormat):
+    """export `User`s including their key as json lines, arrow ipc stream
+    or parquet file"""
+    return export_response(
+        [UserTable.key] + USER_EXPORT_COLUMNS, export_format, "Benutzerliste")
+
+
+@files.get("/loans/export/{export_format}/", response_class=StreamingResponse)
+def export_loans(export_format: ExportFormat):
+    """export the complete borrowing history as json lines, arrow ipc stream
+    or parquet file"""
+    return export_response(LOAN_EXPORT_COLUMNS, export_format, "Ausleihen")
+
+
+def import_user_csv_from_path(file, session):
     """import `Users`s from csv file"""
-    session = Session()
-    df: pd.DataFrame = pd.read_csv(
-        io.StringIO(UnicodeDammit(file.file.read()).unicode_markup)
-    ).replace({np.nan: None})
-    logger.info(f"importing csv with columns:  {df.columns}")
-    logger.info(f"shape:  {df.shape}")
-    df = df[
-        (~df.firstname.isnull())
-        & (~df.lastname.isnull())
-        & (~df.classname.isnull())
-    ]
-    records = [UserTable(User(key=-1, **i))
-               for i in df.to_dict(orient="records")]
-    session.add_all(records)
-    session.commit()
-    return {"status": ImportBooksResponseStatus.success, "import_count": len(df.index)}
-
-
-async def import_books_csv_from_path(file):
-    """import `Book`s from csv file"""
-    session = Session()
-    df: pd.DataFrame = pd.read_csv(file).replace({np.nan: None})
-    logger.info(f"importing csv with columns:  {df.columns}")
-    logger.info(f"shape:  {df.shape}")
-    df = df[
-        (~df.title.isnull())
-        & (~df.author.isnull())
-        & (~df.publisher.isnull())
-        & (~df.number.isnull())
-        & (~df.shorthand.isnull())
-        & (~df.category.isnull())
-    ].drop_duplicates(subset=["number"])
-    logger.info(f"duplicate remove shape:  {df.shape}")
-    records = [BookTable(Book(key=-1, **i))
-               for i in df.to_dict(orient="records")]
-    session.add_all(records)
-    session.commit()
-    return {"status": ImportBooksResponseStatus.success, "import_count": len(df.index)}
-
-
-@files.post("/books/import/csv/")
-async def import_books_csv(file: UploadFile = File(...)):
+    with open(file, "rb") as f:
+        count = import_users(session, read_csv_chunks(f))
+    return {"status": ImportBooksResponseStatus.success, "import_count": count}
+
+
+@files.post("/users/import/csv/", response_model=ImportJobResponseModel, status_code=202)
+def import_user_csv(file: UploadFile = File(...)):
+    """import `Users`s from csv file in the background, the progress can be
+    polled with the returned `job_id`"""
+    return submit_import("users", import_users, file.file).to_dict()
+
+
+def import_books_csv_from_path(file, session):
     """import `Book`s from csv file"""
-    session = Session()
-    df: pd.DataFrame = pd.read_csv(
-        io.StringIO(UnicodeDammit(file.file.read()).unicode_markup)
-    ).replace({np.nan: None})
-    logger.info(f"shape:  {df.shape}")
-    df = df[
-        (~df.title.isnull())
-        & (~df.author.isnull())
-        & (~df.publisher.isnull())
-        & (~df.number.isnull())
-        & (~df.shorthand.isnull())
-        & (~df.category.isnull())
-    ].drop_duplicates(subset=["number"])
-    logger.info(f"duplicate remove shape:  {df.shape}")
-    records = [BookTable(Book(key=-1, **i))
-               for i in df.to_dict(orient="records")]
-    session.add_all(records)
-    session.commit()
-    return {"status": ImportBooksResponseStatus.success, "import_count": len(df.index)}
+    with open(file, "rb") as f:
+        count = import_books(session, read_csv_chunks(f))
+    return {"status": ImportBooksResponseStatus.success, "import_count": count}
+
+
+@files.post("/books/import/csv/", response_model=ImportJobResponseModel, status_code=202)
+def import_books_csv(file: UploadFile = File(...), mode: ImportMode = ImportMode.append):
+    """import `Book`s from csv file in the background, the progress can be
+    polled with the returned `job_id`. With `mode` merge books whose number
+    already exists are updated instead of failing the import"""
+    if mode == ImportMode.merge:
+        return submit_import("books", merge_books, file.file).to_dict()
+    return submit_import("books", import_books, file.file).to_dict()
+
+
+@files.get("/imports/{job_id}", response_model=ImportJobResponseModel)
+def get_import(job_id: str):
+    """returns the progress of the import with the id `job_id`"""
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="import job not found")
+    return job.to_dict()
@@ -0,0 +1,287 @@
+import codecs
+import logging
+from enum import Enum
+from typing import BinaryIO, Iterable
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_string_dtype
+from sqlalchemy import bindparam
+from sqlalchemy.sql import functions
+
+from ..books.fuzzy import index_books_by_number
+from ..configuration import default_conf
+from ..dataclasses.Book import BookTable, normalize_isbn
+from ..dataclasses.User import UserTable
+from ..db.query_cache import BOOKS, USERS, query_cache
+from ..db.repository import chunks
+from ..search import typeahead
+from ..stats.counters import counters
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+# number of rows that are read, inserted and committed at once
+IMPORT_CHUNK_SIZE = default_conf.getint("import_chunk_size", 5000)
+# number of bytes that are checked for valid utf-8 at once
+ENCODING_BLOCK_SIZE = 64 * 1024
+# csv files that are no utf-8 were usually saved by excel on windows
+FALLBACK_ENCODING = "cp1252"
+
+BOOK_COLUMNS = [
+    "title",
+    "author",
+    "publisher",
+    "number",
+    "shorthand",
+    "category",
+    "isbn",
+    "isbn_normalized",
+]
+BOOK_REQUIRED_COLUMNS = [
+    "title",
+    "author",
+    "publisher",
+    "number",
+    "shorthand",
+    "category",
+]
+# columns that are compared when merging books with the same number
+BOOK_MERGE_COLUMNS = [i for i in BOOK_COLUMNS if i != "number"]
+USER_COLUMNS = [
+    "firstname",
+    "lastname",
+    "classname",
+]
+
+
+class ImportMode(str, Enum):
+    """how imported books are combined with the existing books"""
+    # insert all books, fails if a book number already exists
+    append = "append"
+    # insert new books and update existing books with the same number
+    merge = "merge"
+
+
+class ImportProgress:
+    """counters of a running import"""
+
+    def __init__(self):
+        self.rows_parsed = 0
+        self.rows_inserted = 0
+        self.rows_updated = 0
+        self.rows_unchanged = 0
+        self.duplicates_skipped = 0
+        self.rows_invalid = 0
+
+
+def clean_strings(df: pd.DataFrame) -> pd.DataFrame:
+    """strips all values and treats empty values as missing"""
+    return df.apply(
+        lambda column: column.str.strip().replace("", np.nan)
+        if is_string_dtype(column) else column
+    )
+
+
+def prepare_books(df: pd.DataFrame) -> pd.DataFrame:
+    """validates the rows of a books csv, that was read with `dtype=str`,
+    and returns the valid rows with the columns of the books table"""
+    df = clean_strings(df.reindex(columns=BOOK_COLUMNS))
+    number = pd.to_numeric(df.number, errors="coerce")
+    df = df.assign(number=number)[
+        df[BOOK_REQUIRED_COLUMNS].notnull().all(axis=1)
+        & (number % 1 == 0)
+    ]
+    return df.astype({"number": "int64"}).assign(
+        isbn_normalized=lambda df: df.isbn.map(
+            lambda isbn: normalize_isbn(isbn) if isinstance(isbn, str) else None
+        )
+    )
+
+
+def prepare_users(df: pd.DataFrame) -> pd.DataFrame:
+    """validates the rows of a users csv, that was read with `dtype=str`,
+    and returns the valid rows with the columns of the users table"""
+    df = clean_strings(df.reindex(columns=USER_COLUMNS))
+    return df[df.notnull().all(axis=1)]
+
+
+def bulk_insert(session, table, df: pd.DataFrame):
+    """inserts all rows of `df` into `table` with one executemany"""
+    if df.empty:
+        return
+    session.execute(
+        table.insert(),
+        df.astype(object).where(df.notnull(), None).to_dict(orient="records")
+    )
+
+
+def decodes_as(file: BinaryIO, encoding: str) -> bool:
+    """checks whether all of `file` is valid in `encoding` and rewinds it"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        for block in iter(lambda: file.read(ENCODING_BLOCK_SIZE), b""):
+            decoder.decode(block)
+        decoder.decode(b"", final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+    finally:
+        file.seek(0)
+
+
+def detect_encoding(file: BinaryIO) -> str:
+    """returns the encoding of `file`: utf-16 if it starts with its byte
+    order mark, utf-8 if all of it is valid utf-8 and `FALLBACK_ENCODING`
+    otherwise. Raises `ValueError` before anything is imported if
+    the file is not valid in the fallback either. Rewinds the file"""
+    start = file.read(2)
+    file.seek(0)
+    if start in [codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE]:
+        return "utf-16"
+    if decodes_as(file, "utf-8-sig"):
+        return "utf-8-sig"
+    if decodes_as(file, FALLBACK_ENCODING):
+        return FALLBACK_ENCODING
+    raise ValueError(f"file is neither utf-8 nor {FALLBACK_ENCODING} encoded")
+
+
+def read_csv_chunks(file: BinaryIO) -> Iterable[pd.DataFrame]:
+    """reads the csv file `file` of unknown encoding as a sequence of
+    DataFrames of at most `IMPORT_CHUNK_SIZE` rows. Bytes that are invalid
+    in the detected encoding fail the import instead of being replaced"""
+    encoding = detect_encoding(file)
+    logger.info(f"reading csv with encoding {encoding}")
+    return pd.read_csv(
+        codecs.getreader(encoding)(file),
+        dtype=str,
+        chunksize=IMPORT_CHUNK_SIZE
+    )
+
+
+def import_books(session, chunks: Iterable[pd.DataFrame], progress: ImportProgress = None) -> int:
+    """inserts all valid books of `chunks`, commits after every chunk and
+    returns the number of imported books. The counters of `progress` are
+    updated after every chunk"""
+    progress = progress or ImportProgress()
+    numbers = set()
+    for df in chunks:
+        logger.info(f"importing books chunk with shape:  {df.shape}")
+        rows = len(df.index)
+        df = prepare_books(df)
+        valid = len(df.index)
+        df = df[~df.number.duplicated() & ~df.number.isin(numbers)]
+        numbers.update(df.number)
+        bulk_insert(session, BookTable.__table__, df)
+        books = index_books_by_number(session, df.number.tolist())
+        session.commit()
+        typeahead.add_books(books)
+        counters.books_added(len(df.index))
+        query_cache.invalidate(BOOKS)
+        progress.rows_parsed += rows
+        progress.rows_invalid += rows - valid
+        progress.duplicates_skipped += valid - len(df.index)
+        progress.rows_inserted += len(df.index)
+    logger.info(f"imported {progress.rows_inserted} books")
+    return progress.rows_inserted
+
+
+def existing_books(session, numbers) -> pd.DataFrame:
+    """returns the key and the merge columns of the existing books with the
+    given `numbers`"""
+    columns = [BookTable.key, BookTable.number] + [
+        getattr(BookTable, i) for i in BOOK_MERGE_COLUMNS
+    ]
+    return pd.DataFrame(
+        [
+            row
+            for chunk in chunks(list(numbers))
+            for row in session.query(*columns).filter(
+                BookTable.number.in_(chunk)
+            )
+        ],
+        columns=["key", "number"] + BOOK_MERGE_COLUMNS
+    ).astype({"number": "int64"})
+
+
+def merge_books(session, chunks: Iterable[pd.DataFrame], progress: ImportProgress = None) -> int:
+    """inserts the books of `chunks` whose number does not exist yet and
+    updates the existing books with the same number whose values differ.
+    Commits after every chunk and returns the number of inserted and
+    updated books. The counters of `progress` are updated after every
+    chunk"""
+    progress = progress or ImportProgress()
+    numbers = set()
+    update = BookTable.__table__.update().where(
+        BookTable.key == bindparam("book_key")
+    )
+    for df in chunks:
+        logger.info(f"merging books chunk with shape:  {df.shape}")
+        rows = len(df.index)
+        df = prepare_books(df)
+        valid = len(df.index)
+        df = df[~df.number.duplicated() & ~df.number.isin(numbers)]
+        numbers.update(df.number)
+        merged = df.merge(
+            existing_books(session, df.number),
+            on="number",
+            how="left",
+            suffixes=("", "_existing")
+        )
+        new = merged.key.isnull()
+        changed = np.zeros(len(merged.index), dtype=bool)
+        for column in BOOK_MERGE_COLUMNS:
+            imported = merged[column]
+            existing = merged[f"{column}_existing"]
+            changed |= (
+                (imported != existing)
+                & ~(imported.isnull() & existing.isnull())
+            ).to_numpy()
+        updated = ~new & changed
+        bulk_insert(session, BookTable.__table__, merged.loc[new, BOOK_COLUMNS])
+        if updated.any():
+            updates = merged.loc[updated, BOOK_MERGE_COLUMNS]
+            records = updates.astype(object).where(
+                updates.notnull(), None).to_dict(orient="records")
+            for record, key in zip(records, merged.loc[updated, "key"]):
+                record["book_key"] = int(key)
+            session.execute(update, records)
+        books = index_books_by_number(
+            session, merged.loc[new | updated, "number"].tolist())
+        session.commit()
+        typeahead.add_books(books)
+        counters.books_added(int(new.sum()))
+        query_cache.invalidate(BOOKS)
+        progress.rows_parsed += rows
+        progress.rows_invalid += rows - valid
+        progress.duplicates_skipped += valid - len(df.index)
+        progress.rows_inserted += int(new.sum())
+        progress.rows_updated += int(updated.sum())
+        progress.rows_unchanged += int((~new & ~changed).sum())
+    logger.info(
+        f"merged books: {progress.rows_inserted} inserted, {progress.rows_updated} updated")
+    return progress.rows_inserted + progress.rows_updated
+
+
+def import_users(session, chunks: Iterable[pd.DataFrame], progress: ImportProgress = None) -> int:
+    """inserts all valid users of `chunks`, commits after every chunk and
+    returns the number of imported users. The counters of `progress` are
+    updated after every chunk"""
+    progress = progress or ImportProgress()
+    for df in chunks:
+        logger.info(f"importing users chunk with shape:  {df.shape}")
+        rows = len(df.index)
+        df = prepare_users(df)
+        last_key = session.query(functions.max(UserTable.key)).scalar() or 0
+        bulk_insert(session, UserTable.__table__, df)
+        session.commit()
+        typeahead.add_users(session.query(*typeahead.USER_COLUMNS).filter(
+            UserTable.key > last_key
+        ).all())
+        counters.users_added(len(df.index))
+        query_cache.invalidate(USERS)
+        progress.rows_parsed += rows
+        progress.rows_invalid += rows - len(df.index)
+        progress.rows_inserted += len(df.index)
+    logger.info(f"imported {progress.rows_inserted} users")
+    return progress.rows_inserted
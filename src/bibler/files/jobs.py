@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import BinaryIO, Callable, Optional
+from uuid import uuid4
+
+from ..configuration import default_conf
+from ..dataclasses.ImportJob import ImportJobTable
+from ..db.repository import session_scope
+from ..responses.ImportJobResponse import ImportJobStatus
+from .importer import ImportProgress, read_csv_chunks
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+# imports write a lot and sqlite only has one writer at a time, so by
+# default they are run one after another
+executor = ThreadPoolExecutor(
+    max_workers=default_conf.getint("import_workers", 1),
+    thread_name_prefix="bibler-import"
+)
+# number of jobs whose state is kept for polling, the oldest are dropped
+MAX_JOBS = 100
+# counters of `ImportProgress` that are reported and stored with a job
+PROGRESS_COUNTERS = (
+    "rows_parsed",
+    "rows_inserted",
+    "rows_updated",
+    "rows_unchanged",
+    "duplicates_skipped",
+    "rows_invalid",
+)
+
+
+class ImportJob:
+    """a csv import that runs in the background"""
+
+    def __init__(self, kind: str):
+        self.job_id = uuid4().hex
+        self.kind = kind
+        self.status = ImportJobStatus.queued
+        self.created = datetime.now()
+        self.finished = None
+        self.progress = ImportProgress()
+        self.errors = []
+
+    @classmethod
+    def from_table(cls, row: ImportJobTable) -> "ImportJob":
+        """returns the job stored in `row`"""
+        job = cls(row.kind)
+        job.job_id = row.job_id
+        job.status = ImportJobStatus(row.status)
+        job.created = row.created
+        job.finished = row.finished
+        for counter in PROGRESS_COUNTERS:
+            setattr(job.progress, counter, getattr(row, counter))
+        job.errors = json.loads(row.errors)
+        return job
+
+    def save(self):
+        """stores the current state of the job in the database"""
+        with session_scope() as session:
+            session.merge(ImportJobTable(
+                job_id=self.job_id,
+                kind=self.kind,
+                status=self.status.value,
+                created=self.created,
+                finished=self.finished,
+                errors=json.dumps(self.errors),
+                **{i: getattr(self.progress, i) for i in PROGRESS_COUNTERS}
+            ))
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished,
+            **{i: getattr(self.progress, i) for i in PROGRESS_COUNTERS},
+            "errors": list(self.errors),
+        }
+
+
+# the jobs queued or running in this worker process, their progress is
+# only stored in the database once they finished
+jobs = {}
+jobs_lock = threading.Lock()
+
+
+def get_job(job_id: str) -> Optional[ImportJob]:
+    """returns the import job with the id `job_id` if it is known"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is not None:
+        return job
+    with session_scope() as session:
+        row = session.query(ImportJobTable).filter(
+            ImportJobTable.job_id == job_id
+        ).first()
+        return None if row is None else ImportJob.from_table(row)
+
+
+def drop_old_jobs(session):
+    """deletes all but the `MAX_JOBS` newest jobs"""
+    newest = session.query(ImportJobTable.job_id).order_by(
+        ImportJobTable.created.desc()
+    ).limit(MAX_JOBS)
+    session.query(ImportJobTable).filter(
+        ImportJobTable.job_id.notin_(newest.subquery())
+    ).delete(synchronize_session=False)
+
+
+def run_import(job: ImportJob, import_function: Callable, path: str):
+    """imports the csv file at `path` with `import_function` and deletes
+    the file afterwards"""
+    job.status = ImportJobStatus.running
+    try:
+        job.save()
+        with session_scope() as session, open(path, "rb") as f:
+            import_function(session, read_csv_chunks(f), job.progress)
+        job.status = ImportJobStatus.success
+    except Exception as e:
+        logger.exception(f"import {job.job_id} failed")
+        job.errors.append(str(e))
+        job.status = ImportJobStatus.fail
+    finally:
+        job.finished = datetime.now()
+        os.remove(path)
+        try:
+            job.save()
+        finally:
+            with jobs_lock:
+                jobs.pop(job.job_id, None)
+
+
+def submit_import(kind: str, import_function: Callable, file: BinaryIO) -> ImportJob:
+    """copies the uploaded `file` to disk and queues its import with
+    `import_function`"""
+    with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as f:
+        shutil.copyfileobj(file, f)
+    job = ImportJob(kind)
+    job.save()
+    with session_scope() as session:
+        drop_old_jobs(session)
+    with jobs_lock:
+        jobs[job.job_id] = job
+    executor.submit(run_import, job, import_function, f.name)
+    logger.info(f"queued {kind} import {job.job_id}")
+    return job
@@ -0,0 +1,65 @@
+import logging
+import os
+import threading
+from typing import Iterable, List
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+
+class CoverIndex:
+    """keys of the books that have a cover in `directory`. The directory is
+    only scanned again when its modification time changes, which happens
+    whenever a cover is added, removed or renamed, so covers copied in by
+    hand are picked up as well"""
+
+    def __init__(self, directory: str, suffix: str = ".png"):
+        self.directory = directory
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.mtime = None
+
+    def scan(self):
+        """reads the keys of all covers in the directory"""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            mtime, names = None, []
+        keys = set()
+        for name in names:
+            stem, suffix = os.path.splitext(name)
+            if suffix == self.suffix and stem.isdigit():
+                keys.add(int(stem))
+        self.keys, self.mtime = keys, mtime
+        logger.info(f"indexed {len(keys)} covers")
+
+    def refresh(self):
+        """scans the directory again if it changed since the last scan"""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is None or mtime != self.mtime:
+            self.scan()
+
+    def existing(self, book_keys: Iterable[int]) -> List[int]:
+        """returns the `book_keys` that have a cover, in their order"""
+        with self.lock:
+            self.refresh()
+            return [i for i in book_keys if i in self.keys]
+
+    def __contains__(self, book_key: int) -> bool:
+        return bool(self.existing([book_key]))
+
+    def add(self, book_key: int):
+        """records a cover written by bibler itself"""
+        with self.lock:
+            self.refresh()
+            self.keys.add(book_key)
+
+    def remove(self, book_key: int):
+        with self.lock:
+            self.refresh()
+            self.keys.discard(book_key)
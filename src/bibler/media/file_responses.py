@@ -0,0 +1,139 @@
+import hashlib
+import os
+import re
+from email.utils import formatdate, parsedate
+from typing import Optional, Tuple
+
+import aiofiles
+import aiofiles.os
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeFileResponse(FileResponse):
+    """`FileResponse` that only sends the bytes `byte_range` of the file"""
+
+    def __init__(self, path: str, byte_range: Tuple[int, int], size: int, **kwargs):
+        super().__init__(path, status_code=206, **kwargs)
+        self.start, self.end = byte_range
+        self.headers["content-range"] = f"bytes {self.start}-{self.end}/{size}"
+        self.headers["content-length"] = str(self.end - self.start + 1)
+
+    async def __call__(self, scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        async with aiofiles.open(self.path, mode="rb") as file:
+            await file.seek(self.start)
+            remaining = self.end - self.start + 1
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                remaining -= len(chunk)
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": remaining > 0 and len(chunk) > 0,
+                })
+                if not chunk:
+                    break
+
+
+def validators(stat_result: os.stat_result):
+    """returns the `ETag` and `Last-Modified` of a file"""
+    etag_base = f"{stat_result.st_mtime}-{stat_result.st_size}"
+    return (
+        f'"{hashlib.md5(etag_base.encode()).hexdigest()}"',
+        formatdate(stat_result.st_mtime, usegmt=True),
+    )
+
+
+def is_not_modified(request_headers: Headers, etag: str, last_modified: str) -> bool:
+    """checks the conditional headers of a request, `If-None-Match` takes
+    precedence over `If-Modified-Since` like in RFC 7232"""
+    if "if-none-match" in request_headers:
+        tags = [
+            i.strip()[2:] if i.strip().startswith("W/") else i.strip()
+            for i in request_headers["if-none-match"].split(",")
+        ]
+        return etag in tags or "*" in tags
+    if "if-modified-since" in request_headers:
+        if_modified_since = parsedate(request_headers["if-modified-since"])
+        return (
+            if_modified_since is not None
+            and if_modified_since >= parsedate(last_modified)
+        )
+    return False
+
+
+def parse_range(request_headers: Headers, etag: str, size: int) -> Optional[Tuple[int, int]]:
+    """returns the first and last byte requested by the `Range` header, or
+    None if the whole file should be sent. Only single ranges are supported,
+    for anything else the whole file is sent. Raises `ValueError` if the
+    range can not be satisfied"""
+    if "range" not in request_headers:
+        return None
+    if request_headers.get("if-range", etag) != etag:
+        # the client's copy is outdated, it needs the whole new file
+        return None
+    match = RANGE_PATTERN.match(request_headers["range"].strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # the last `end` bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError(f"range {start}-{end} outside of {size} bytes")
+    return start, end
+
+
+async def cached_file_response(request: Request, path: str, media_type: str, cache_control: str) -> Response:
+    """serves the file at `path` with validators and `Cache-Control`,
+    answers conditional requests with 304 and range requests with 206.
+    Raises `FileNotFoundError` if there is no file at `path`"""
+    stat_result = await aiofiles.os.stat(path)
+    etag, last_modified = validators(stat_result)
+    headers = {
+        "etag": etag,
+        "last-modified": last_modified,
+        "cache-control": cache_control,
+        "accept-ranges": "bytes",
+    }
+    if is_not_modified(request.headers, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    try:
+        byte_range = parse_range(request.headers, etag, stat_result.st_size)
+    except ValueError:
+        return Response(
+            status_code=416,
+            headers={"content-range": f"bytes */{stat_result.st_size}"}
+        )
+    if byte_range is not None:
+        return RangeFileResponse(
+            path,
+            byte_range,
+            stat_result.st_size,
+            headers=headers,
+            media_type=media_type,
+            stat_result=stat_result,
+            method=request.method,
+        )
+    return FileResponse(
+        path,
+        headers=headers,
+        media_type=media_type,
+        stat_result=stat_result,
+        method=request.method,
+    )
@@ -1,28 +1,107 @@
-import io
 import logging
 import os
+from typing import List, Optional
 
+from fastapi import HTTPException, Query
+from fastapi.datastructures import UploadFile
+from fastapi.params import File
 from fastapi.routing import APIRouter
-from starlette.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from ..configuration import default_conf
+from ..dataclasses.Book import BookTable
+from ..db.repository import session_scope
+from ..responses.UploadCoverResponse import (UploadCoverResponseModel,
+                                             UploadCoverResponseStatus)
+from .cover_index import CoverIndex
+from .file_responses import cached_file_response
+from .thumbnails import thumbnails
+from .uploads import (CoverTooLarge, InvalidCover, normalize_cover,
+                      receive_upload)
 
 logger = logging.getLogger("Bibler-server")
 logger.setLevel(logging.INFO)
 media = APIRouter()
 
+MEDIA_DIR = "data/media"
+# browsers reuse a cover for this long without asking, afterwards they
+# revalidate it with its ETag and usually get a 304
+COVER_CACHE_CONTROL = f"public, max-age={default_conf.getint('cover_max_age', 3600)}"
+THUMBNAIL_CACHE_CONTROL = f"public, max-age={default_conf.getint('thumbnail_max_age', 604800)}"
+covers = CoverIndex(MEDIA_DIR)
+
+
+def cover_path(book_key: int) -> str:
+    """returns the path of the cover of the book with the key `book_key`"""
+    return os.path.join(MEDIA_DIR, str(book_key) + ".png")
+
 
 @media.get("/exists/{book_key}", response_model=str)
-async def book_cover_exists(book_key: int):
+def book_cover_exists(book_key: int):
     """returns if a book with the key `book_key` exists"""
-    if os.path.exists(os.path.join("data/media", str(book_key) + ".png")):
+    if book_key in covers:
         return "True"
     return "False"
 
 
+@media.post("/exists", response_model=List[int])
+def book_covers_exist(book_keys: List[int]):
+    """returns the keys of `book_keys` that have a cover"""
+    return covers.existing(book_keys)
+
+
 @media.get("/{book_key}")
-async def get_book_cover(book_key: int):
-    """returns the book cover of a book with the key `book_key`"""
-    path = os.path.join("data/media", str(book_key) + ".png")
+async def get_book_cover(book_key: int, request: Request, w: Optional[int] = Query(None, ge=1)):
+    """returns the book cover of a book with the key `book_key`, scaled
+    down to a thumbnail about `w` pixels wide if `w` is given"""
+    path = cover_path(book_key)
     logger.info(f"loading {path}")
-    if os.path.exists(path):
-        with open(path, "rb") as f:
-            return StreamingResponse(io.BytesIO(f.read()), media_type="image/png")
+    try:
+        if w is None or not thumbnails.enabled:
+            return await cached_file_response(
+                request, path, "image/png", COVER_CACHE_CONTROL)
+        try:
+            thumbnail = await thumbnails.get(path, w)
+        except FileNotFoundError:
+            raise
+        except OSError as e:
+            # pillow can not read the original, serve it unscaled
+            logger.warning(f"could not render a thumbnail of {path}: {e}")
+            return await cached_file_response(
+                request, path, "image/png", COVER_CACHE_CONTROL)
+        return await cached_file_response(
+            request, thumbnail, "image/jpeg", THUMBNAIL_CACHE_CONTROL)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="cover not found")
+
+
+def book_exists(book_key: int) -> bool:
+    """checks whether a book with the key `book_key` exists"""
+    with session_scope() as session:
+        return session.query(
+            session.query(BookTable).filter(BookTable.key == book_key).exists()
+        ).scalar()
+
+
+@media.put("/{book_key}", response_model=UploadCoverResponseModel)
+async def upload_book_cover(book_key: int, file: UploadFile = File(...)):
+    """stores the uploaded image as cover of the book with the key
+    `book_key`, replacing the current cover. The image is converted to png
+    and scaled down in a worker process before it is moved into place"""
+    if not await run_in_threadpool(book_exists, book_key):
+        return {"status": UploadCoverResponseStatus.book_unknown}
+    try:
+        upload = await receive_upload(file, MEDIA_DIR)
+    except CoverTooLarge:
+        return {"status": UploadCoverResponseStatus.too_large}
+    path = cover_path(book_key)
+    try:
+        await thumbnails.run(normalize_cover, upload, path)
+    except InvalidCover as e:
+        logger.error(f"invalid cover for book {book_key}: {e}")
+        return {"status": UploadCoverResponseStatus.invalid}
+    thumbnails.discard(path)
+    covers.add(book_key)
+    logger.info(f"stored cover {path}")
+    return {"status": UploadCoverResponseStatus.success}
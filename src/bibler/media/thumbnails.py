@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import aiofiles.os
+
+from ..configuration import default_conf
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    # without pillow covers are only served in their original size
+    Image = None
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+# requested widths are rounded up to one of these, so that arbitrary `w`
+# parameters can not fill the cache with nearly identical variants
+THUMBNAIL_WIDTHS = (64, 128, 256, 512)
+THUMBNAIL_QUALITY = 80
+# bumped whenever the rendering changes, so old variants are not reused
+THUMBNAIL_VERSION = 1
+
+
+def thumbnail_width(width: int) -> int:
+    """returns the smallest supported width that is at least `width`"""
+    return next((i for i in THUMBNAIL_WIDTHS if i >= width), THUMBNAIL_WIDTHS[-1])
+
+
+def file_digest(path: str) -> str:
+    """returns the sha256 of the content of the file at `path`"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def render_thumbnail(source: str, target: str, width: int) -> int:
+    """scales the image at `source` down to `width` pixels, stores it as
+    jpeg at `target` and returns the size of the thumbnail. Runs in a worker
+    process, the thumbnail is written to a temporary file first so that no
+    one ever sees a partially written thumbnail"""
+    with Image.open(source) as image:
+        image = image.convert("RGB")
+        image.thumbnail((width, width * 4), Image.LANCZOS)
+        fd, path = tempfile.mkstemp(suffix=".jpg", dir=os.path.dirname(target))
+        with os.fdopen(fd, "wb") as f:
+            image.save(f, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    os.replace(path, target)
+    return os.path.getsize(target)
+
+
+class ThumbnailCache:
+    """scaled down covers stored on disk under the digest of the original
+    and the width, so an unchanged cover is never rendered twice and a
+    replaced cover gets new thumbnails. The least recently used thumbnails
+    are deleted once the cache grows beyond `max_size` bytes.
+
+    The methods are only called from the event loop, only the rendering
+    runs in the worker processes, so the bookkeeping needs no locks"""
+
+    def __init__(self, directory: str, max_size: int, workers: int):
+        self.directory = directory
+        self.enabled = Image is not None
+        self.max_size = max_size
+        self.workers = workers
+        self.pool = None
+        self.entries = None
+        self.size = 0
+        # path of an original -> (mtime, size, digest)
+        self.digests = {}
+        # name of a thumbnail -> future of its rendering
+        self.pending = {}
+
+    def load(self):
+        """indexes the thumbnails already on disk, oldest first"""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                stat_result = entry.stat()
+                files.append(
+                    (stat_result.st_atime, entry.name, stat_result.st_size))
+        self.entries = OrderedDict(
+            (name, size) for _, name, size in sorted(files))
+        self.size = sum(self.entries.values())
+        logger.info(
+            f"found {len(self.entries)} thumbnails with {self.size} bytes")
+
+    def run(self, function, *args):
+        """runs `function` in the worker processes"""
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        return asyncio.get_event_loop().run_in_executor(self.pool, function, *args)
+
+    async def digest(self, source: str) -> str:
+        """returns the digest of the original `source`, it is only computed
+        again if the file changed"""
+        stat_result = await aiofiles.os.stat(source)
+        version = (stat_result.st_mtime_ns, stat_result.st_size)
+        cached = self.digests.get(source)
+        if cached is None or cached[:2] != version:
+            cached = (*version, await self.run(file_digest, source))
+            self.digests[source] = cached
+        return cached[2]
+
+    async def get(self, source: str, width: int) -> str:
+        """returns the path of the thumbnail of `source` that is `width`
+        pixels wide and renders it if it is not cached yet. Raises
+        `FileNotFoundError` if `source` does not exist and `OSError` if it
+        can not be read as an image"""
+        if self.entries is None:
+            self.load()
+        width = thumbnail_width(width)
+        name = f"{await self.digest(source)}-{width}-v{THUMBNAIL_VERSION}.jpg"
+        path = os.path.join(self.directory, name)
+        if name in self.entries:
+            try:
+                await aiofiles.os.stat(path)
+                self.entries.move_to_end(name)
+                return path
+            except FileNotFoundError:
+                # deleted behind the back of the cache, render it again
+                self.size -= self.entries.pop(name)
+                logger.warning(f"thumbnail {name} is missing")
+        if name not in self.pending:
+            self.pending[name] = asyncio.ensure_future(
+                self.run(render_thumbnail, source, path, width))
+        try:
+            size = await self.pending[name]
+        finally:
+            self.pending.pop(name, None)
+        if name not in self.entries:
+            self.entries[name] = size
+            self.size += size
+            self.evict()
+        return path
+
+    def evict(self):
+        """deletes the least recently used thumbnails until the cache fits
+        into `max_size`, the newest thumbnail is always kept"""
+        while self.size > self.max_size and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            logger.info(f"evicted thumbnail {name}")
+
+    def discard(self, source: str):
+        """forgets the digest of `source`, e.g. because it was replaced"""
+        self.digests.pop(source, None)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+thumbnails = ThumbnailCache(
+    os.path.join("data", "media", "thumbnails"),
+    default_conf.getint("thumbnail_cache_size", 100 * 1024 * 1024),
+    default_conf.getint("thumbnail_workers", 2),
+)
@@ -0,0 +1,87 @@
+import logging
+import os
+import tempfile
+
+import aiofiles
+import aiofiles.os
+from fastapi import UploadFile
+
+from ..configuration import default_conf
+from .thumbnails import Image
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_COVER_SIZE = default_conf.getint("cover_max_size", 10 * 1024 * 1024)
+# larger covers are scaled down, the catalogue never shows them any bigger
+MAX_COVER_DIMENSION = default_conf.getint("cover_max_dimension", 1600)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class InvalidCover(Exception):
+    """the uploaded file is no image bibler can use as cover"""
+
+
+class CoverTooLarge(Exception):
+    """the uploaded file exceeds `MAX_COVER_SIZE`"""
+
+
+def normalize_cover(upload: str, target: str):
+    """validates the uploaded image at `upload`, stores it as png of at
+    most `MAX_COVER_DIMENSION` pixels and atomically moves it to `target`.
+    Runs in a worker process and always deletes `upload`"""
+    directory = os.path.dirname(target)
+    try:
+        if Image is None:
+            # without pillow only pngs are accepted and stored as they are
+            with open(upload, "rb") as f:
+                if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                    raise InvalidCover("not a png")
+            os.replace(upload, target)
+            return
+        try:
+            with Image.open(upload) as image:
+                image.verify()
+            with Image.open(upload) as image:
+                image = image.convert(
+                    "RGBA" if "A" in image.getbands() else "RGB")
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            raise InvalidCover(str(e))
+        image.thumbnail(
+            (MAX_COVER_DIMENSION, MAX_COVER_DIMENSION), Image.LANCZOS)
+        fd, path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, "PNG", optimize=True)
+            os.replace(path, target)
+        except BaseException:
+            os.remove(path)
+            raise
+    finally:
+        if os.path.exists(upload):
+            os.remove(upload)
+
+
+async def receive_upload(file: UploadFile, directory: str) -> str:
+    """streams `file` into a temporary file in `directory` without blocking
+    the event loop and returns its path. Raises `CoverTooLarge` if the file
+    is larger than `MAX_COVER_SIZE`"""
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".upload", dir=directory)
+    os.close(fd)
+    size = 0
+    try:
+        async with aiofiles.open(path, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_COVER_SIZE:
+                    raise CoverTooLarge(f"cover larger than {MAX_COVER_SIZE} bytes")
+                await f.write(chunk)
+    except BaseException:
+        await aiofiles.os.remove(path)
+        raise
+    return path
@@ -0,0 +1,14 @@
+from datetime import date
+from typing import Optional
+
+from pydantic import BaseModel
+
+from .BorrowResponse import BorrowResponseStatus
+
+
+class BatchBorrowResponseRecord(BaseModel):
+    """Response record for one book of a batch borrowing request"""
+    user_key: int
+    book_key: int
+    status: BorrowResponseStatus
+    return_date: Optional[date]
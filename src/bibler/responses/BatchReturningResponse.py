@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+from .ReturningResponse import ReturningResponseStatus
+
+
+class BatchReturningResponseRecord(BaseModel):
+    """Response record for one book of a batch returning request"""
+    user_key: int
+    book_key: int
+    status: ReturningResponseStatus
@@ -0,0 +1,31 @@
+from datetime import date
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class BookLookupResponseStatus(Enum):
+    """status codes for looking up a scanned book"""
+    available = "book available"
+    borrowed = "book borrowed"
+    book_unknown = "book unknown"
+
+
+class BookLookupResponseModel(BaseModel):
+    """Response model for a scanned book and its current loan"""
+    status: BookLookupResponseStatus
+    key: Optional[int]
+    title: Optional[str]
+    author: Optional[str]
+    publisher: Optional[str]
+    number: Optional[int]
+    shorthand: Optional[str]
+    category: Optional[str]
+    isbn: Optional[str]
+    user_key: Optional[int]
+    firstname: Optional[str]
+    lastname: Optional[str]
+    classname: Optional[str]
+    start_date: Optional[date]
+    expiration_date: Optional[date]
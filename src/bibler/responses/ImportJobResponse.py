@@ -0,0 +1,29 @@
+from datetime import datetime
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class ImportJobStatus(Enum):
+    """status codes of a background import"""
+    queued = "import queued"
+    running = "import running"
+    success = "successfully imported"
+    fail = "import failed"
+
+
+class ImportJobResponseModel(BaseModel):
+    """Response model for the state of a background import"""
+    job_id: str
+    kind: str
+    status: ImportJobStatus
+    created: datetime
+    finished: Optional[datetime]
+    rows_parsed: int
+    rows_inserted: int
+    rows_updated: int
+    rows_unchanged: int
+    duplicates_skipped: int
+    rows_invalid: int
+    errors: List[str]
@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+
+
+class LoanStatisticsRecord(BaseModel):
+    """Response record for the loans of one period, category or class"""
+    group: str
+    started: int
+    returned: int
+    overdue: int
@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+
+
+class StatisticsSummaryResponseModel(BaseModel):
+    """Response model for all statistics counters at once"""
+    books: int
+    users: int
+    borrowed: int
+    overdue: int
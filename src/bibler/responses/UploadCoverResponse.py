@@ -0,0 +1,16 @@
+from enum import Enum
+
+from pydantic import BaseModel
+
+
+class UploadCoverResponseStatus(Enum):
+    """status codes for uploading a book cover"""
+    success = "cover uploaded"
+    book_unknown = "book unknown"
+    too_large = "cover too large"
+    invalid = "file is not an image"
+
+
+class UploadCoverResponseModel(BaseModel):
+    """"""
+    status: UploadCoverResponseStatus
@@ -0,0 +1,101 @@
+import threading
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, List, Tuple
+
+from ..books.fuzzy import WORD, fold
+
+
+def words(*texts: str) -> List[str]:
+    """returns the folded words of all `texts`"""
+    return [i for text in texts for i in WORD.findall(fold(text or ""))]
+
+
+class PrefixIndex:
+    """sorted list of (word, key) pairs that finds all keys with a word
+    starting with a prefix by binary search. Every key has a payload that
+    is returned for it, so a lookup never touches the database"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: List[Tuple[str, int]] = []
+        self.words: Dict[int, List[str]] = {}
+        self.payloads: Dict[int, Any] = {}
+
+    def rebuild(self, items: Iterable[Tuple[int, List[str], Any]]):
+        """replaces the index with `items`, tuples of key, words and payload"""
+        entries, words, payloads = [], {}, {}
+        for key, item_words, payload in items:
+            words[key] = sorted(set(item_words))
+            payloads[key] = payload
+            entries.extend((i, key) for i in words[key])
+        entries.sort()
+        with self.lock:
+            self.entries, self.words, self.payloads = entries, words, payloads
+
+    def add(self, key: int, item_words: List[str], payload: Any):
+        """adds or replaces the item with the key `key`"""
+        with self.lock:
+            self._remove(key)
+            self.words[key] = sorted(set(item_words))
+            self.payloads[key] = payload
+            for i in self.words[key]:
+                insort(self.entries, (i, key))
+
+    def add_many(self, items: Iterable[Tuple[int, List[str], Any]]):
+        """adds or replaces `items`, tuples of key, words and payload. The
+        new entries are sorted once and merged with the existing ones, so a
+        bulk load does not pay for an insertion into the list per word"""
+        words, payloads = {}, {}
+        for key, item_words, payload in items:
+            words[key] = sorted(set(item_words))
+            payloads[key] = payload
+        added = sorted((i, key) for key in words for i in words[key])
+        with self.lock:
+            replaced = words.keys() & self.words.keys()
+            entries = self.entries
+            if replaced:
+                entries = [i for i in entries if i[1] not in replaced]
+            # both lists are sorted, timsort merges the two runs in linear time
+            entries = entries + added
+            entries.sort()
+            self.entries = entries
+            self.words.update(words)
+            self.payloads.update(payloads)
+
+    def remove(self, key: int):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key: int):
+        for i in self.words.pop(key, []):
+            position = bisect_left(self.entries, (i, key))
+            if position < len(self.entries) and self.entries[position] == (i, key):
+                del self.entries[position]
+        self.payloads.pop(key, None)
+
+    def search(self, query: str, limit: int) -> List[Any]:
+        """returns the payloads of up to `limit` items that have a word
+        starting with every word of `query`. The longest word is looked
+        up in the index, the others are checked on its matches only"""
+        prefixes = sorted(set(words(query)), key=len, reverse=True)
+        if not prefixes:
+            return []
+        first, others = prefixes[0], prefixes[1:]
+        results = []
+        seen = set()
+        with self.lock:
+            position = bisect_left(self.entries, (first,))
+            while position < len(self.entries) and len(results) < limit:
+                word, key = self.entries[position]
+                position += 1
+                if not word.startswith(first):
+                    break
+                if key in seen:
+                    continue
+                seen.add(key)
+                if all(
+                    any(i.startswith(prefix) for i in self.words[key])
+                    for prefix in others
+                ):
+                    results.append(self.payloads[key])
+        return results
@@ -0,0 +1,65 @@
+import logging
+
+from ..dataclasses.Book import BookTable
+from ..dataclasses.User import UserTable
+from .prefix_index import PrefixIndex, words
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+users_typeahead = PrefixIndex()
+books_typeahead = PrefixIndex()
+USER_COLUMNS = [
+    UserTable.key,
+    UserTable.firstname,
+    UserTable.lastname,
+    UserTable.classname,
+]
+BOOK_COLUMNS = [
+    BookTable.key,
+    BookTable.title,
+    BookTable.author,
+    BookTable.number,
+]
+
+
+def user_entry(user):
+    """returns key, words and payload of a `UserTable` or a row with the
+    `USER_COLUMNS`"""
+    return (
+        user.key,
+        words(user.lastname, user.firstname, user.classname),
+        {i.key: getattr(user, i.key) for i in USER_COLUMNS}
+    )
+
+
+def book_entry(book):
+    """returns key, words and payload of a `BookTable` or a row with the
+    `BOOK_COLUMNS`"""
+    return (
+        book.key,
+        words(book.title, book.author),
+        {i.key: getattr(book, i.key) for i in BOOK_COLUMNS}
+    )
+
+
+def add_users(users):
+    """adds or replaces `users`, `UserTable`s or rows with the
+    `USER_COLUMNS`, in the typeahead index. Call after their commit"""
+    users_typeahead.add_many(map(user_entry, users))
+
+
+def add_books(books):
+    """adds or replaces `books`, `BookTable`s or rows with the
+    `BOOK_COLUMNS`, in the typeahead index. Call after their commit"""
+    books_typeahead.add_many(map(book_entry, books))
+
+
+def rebuild_typeahead(session):
+    """builds both typeahead indexes from the database"""
+    users = session.query(*USER_COLUMNS).all()
+    books = session.query(*BOOK_COLUMNS).all()
+    users_typeahead.rebuild(map(user_entry, users))
+    books_typeahead.rebuild(map(book_entry, books))
+    logger.info(
+        f"built typeahead indexes of {len(users)} users and {len(books)} books")
@@ -0,0 +1,164 @@
+import logging
+import threading
+from collections import Counter
+from datetime import date, datetime
+
+import sqlalchemy
+from sqlalchemy.sql import functions
+
+from ..dataclasses.Book import BookTable
+from ..dataclasses.BorrowingUser import BorrowingUserTable
+from ..dataclasses.CacheGeneration import CacheGenerationTable
+from ..dataclasses.User import UserTable
+from ..db.query_cache import INCREMENT_GENERATION
+from ..db.repository import engine, session_scope
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+# tag of the generation of the counters in the cache generations
+STATISTICS = "statistics"
+
+
+class StatisticsCache:
+    """in memory counters of books, users and loans. They are counted once
+    with `recount` and afterwards kept up to date by the write paths, which
+    report their changes after they have been committed.
+
+    Every change increases the generation of the counters in the database.
+    A worker process only applies a change to its own counters if no other
+    worker changed them since, otherwise and whenever the generation was
+    increased by another worker the counters are counted again on the next
+    read, so all workers report the same numbers.
+
+    Open loans are counted per expiration date, so the number of overdue
+    books can be derived for any day without touching the database"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.books = 0
+        self.users = 0
+        self.open_loans = Counter()
+        # generation the counters are up to date with, None if they are not
+        self.generation = None
+
+    def stored_generation(self, connection) -> int:
+        """returns the generation of the counters in the database"""
+        table = CacheGenerationTable.__table__
+        return connection.execute(
+            sqlalchemy.select([table.c.generation]).where(
+                table.c.tag == STATISTICS)
+        ).scalar() or 0
+
+    def recount(self, session=None):
+        """replaces all counters with the counts from the database"""
+        if session is None:
+            with session_scope() as session:
+                return self.recount(session)
+        with self.lock:
+            # read before counting, a change committed while counting makes
+            # the next read count again
+            self.generation = self.stored_generation(session)
+            self.books = session.query(functions.count(BookTable.key)).scalar()
+            self.users = session.query(functions.count(UserTable.key)).scalar()
+            self.open_loans = Counter(dict(
+                session.query(
+                    BorrowingUserTable.expiration_date,
+                    functions.count(BorrowingUserTable.key)
+                ).filter(
+                    BorrowingUserTable.return_date == None
+                ).group_by(
+                    BorrowingUserTable.expiration_date
+                ).all()
+            ))
+        logger.info(f"recounted statistics: {self.counts()}")
+
+    def refresh(self):
+        """counts again if the counters were changed by another worker"""
+        with engine.connect() as connection:
+            generation = self.stored_generation(connection)
+        if generation != self.generation:
+            self.recount()
+
+    def changed(self, books: int = 0, users: int = 0, loans=()):
+        """records a committed change of `books` and `users` and of the open
+        loans by the `(expiration_date, count)` pairs of `loans`"""
+        with self.lock:
+            with engine.begin() as connection:
+                connection.execute(INCREMENT_GENERATION, tag=STATISTICS)
+                generation = self.stored_generation(connection)
+            if self.generation is None or generation != self.generation + 1:
+                # changed by another worker in between, count again
+                self.generation = None
+                return
+            self.generation = generation
+            self.books += books
+            self.users += users
+            for expiration_date, count in loans:
+                self.open_loans[expiration_date] += count
+                if self.open_loans[expiration_date] <= 0:
+                    del self.open_loans[expiration_date]
+
+    def books_added(self, count: int = 1):
+        self.changed(books=count)
+
+    def books_removed(self, count: int = 1):
+        self.changed(books=-count)
+
+    def users_added(self, count: int = 1):
+        self.changed(users=count)
+
+    def users_removed(self, count: int = 1):
+        self.changed(users=-count)
+
+    def loan_started(self, expiration_date: date, count: int = 1):
+        self.changed(loans=[(expiration_date, count)])
+
+    def loan_ended(self, expiration_date: date, count: int = 1):
+        self.changed(loans=[(expiration_date, -count)])
+
+    def loan_extended(self, expiration_date: date, new_expiration_date: date):
+        self.changed(loans=[(expiration_date, -1), (new_expiration_date, 1)])
+
+    def borrowed(self) -> int:
+        """returns the number of currently borrowed books"""
+        self.refresh()
+        return self.counts()["borrowed"]
+
+    def overdue(self) -> int:
+        """returns the number of borrowed books whose expiration date has passed"""
+        self.refresh()
+        return self.counts()["overdue"]
+
+    def count_books(self) -> int:
+        """returns the number of books"""
+        self.refresh()
+        return self.counts()["books"]
+
+    def count_users(self) -> int:
+        """returns the number of users"""
+        self.refresh()
+        return self.counts()["users"]
+
+    def counts(self):
+        """returns all counters of this worker as they are"""
+        today = datetime.now().date()
+        with self.lock:
+            return {
+                "books": self.books,
+                "users": self.users,
+                "borrowed": sum(self.open_loans.values()),
+                "overdue": sum(
+                    count
+                    for expiration_date, count in self.open_loans.items()
+                    if expiration_date < today
+                ),
+            }
+
+    def summary(self):
+        """returns all counters at once"""
+        self.refresh()
+        return self.counts()
+
+
+counters = StatisticsCache()
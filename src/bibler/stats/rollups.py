@@ -0,0 +1,204 @@
+import logging
+from collections import Counter, defaultdict
+from datetime import date, datetime
+from enum import Enum
+from typing import Iterable, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy.sql import functions
+
+from ..dataclasses.Book import BookTable
+from ..dataclasses.BorrowingUser import BorrowingUserTable
+from ..dataclasses.LoanRollup import LoanRollupTable
+from ..dataclasses.User import UserTable
+
+logger = logging.getLogger("Bibler-server")
+logger.setLevel(logging.INFO)
+
+ROLLUP_COLUMNS = ["started", "returned", "due", "returned_in_time"]
+
+
+class LoanStatisticsGrouping(str, Enum):
+    """how the daily rollups are aggregated by the range queries"""
+    day = "day"
+    week = "week"
+    month = "month"
+    category = "category"
+    classname = "classname"
+
+
+GROUP_COLUMNS = {
+    LoanStatisticsGrouping.day: LoanRollupTable.day,
+    LoanStatisticsGrouping.week: sqlalchemy.func.strftime(
+        "%Y-W%W", LoanRollupTable.day),
+    LoanStatisticsGrouping.month: sqlalchemy.func.strftime(
+        "%Y-%m", LoanRollupTable.day),
+    LoanStatisticsGrouping.category: LoanRollupTable.category,
+    LoanStatisticsGrouping.classname: LoanRollupTable.classname,
+}
+
+
+RollupEvent = Tuple[date, Optional[str], Optional[str], str, int]
+
+
+def add_to_rollups(session, events: Iterable[RollupEvent]):
+    """adds the `events`, tuples of day, category, class, rollup column and
+    amount, to the daily rollups. Must run in the transaction of the change
+    it records, so that the rollups are committed or rolled back with it"""
+    totals = defaultdict(Counter)
+    for day, category, classname, column, amount in events:
+        totals[(day, category or "", classname or "")][column] += amount
+    table = LoanRollupTable.__table__
+    for (day, category, classname), increments in totals.items():
+        # sqlite holds the write lock from the update until the commit, so
+        # no other transaction can insert the same row in between
+        updated = session.execute(
+            table.update().where(
+                sqlalchemy.and_(
+                    table.c.day == day,
+                    table.c.category == category,
+                    table.c.classname == classname,
+                )
+            ).values({
+                table.c[column]: table.c[column] + amount
+                for column, amount in increments.items()
+            })
+        ).rowcount
+        if updated == 0:
+            session.execute(table.insert().values(
+                day=day,
+                category=category,
+                classname=classname,
+                **increments
+            ))
+
+
+def loans_started(
+        session,
+        loans: Iterable[Tuple[Optional[str], Optional[str], date, date]]):
+    """records `loans`, tuples of the category of the book, the class of
+    the user, the start date and the expiration date"""
+    add_to_rollups(session, [
+        event
+        for category, classname, start_date, expiration_date in loans
+        for event in (
+            (start_date, category, classname, "started", 1),
+            (expiration_date, category, classname, "due", 1),
+        )
+    ])
+
+
+def loans_returned(
+        session,
+        loans: Iterable[Tuple[Optional[str], Optional[str], date]],
+        return_date: date):
+    """records the return of `loans`, tuples of the category of the book,
+    the class of the user and the expiration date, on `return_date`. Only
+    pass loans whose update was confirmed to have closed them"""
+    events = []
+    for category, classname, expiration_date in loans:
+        events.append((return_date, category, classname, "returned", 1))
+        if return_date <= expiration_date:
+            events.append(
+                (expiration_date, category, classname, "returned_in_time", 1))
+    add_to_rollups(session, events)
+
+
+def loan_extended(
+        session,
+        category: Optional[str],
+        classname: Optional[str],
+        expiration_date: date,
+        new_expiration_date: date):
+    """moves a loan from the day it was due to its new expiration date.
+    Only call it once the update of the loan was confirmed"""
+    add_to_rollups(session, [
+        (expiration_date, category, classname, "due", -1),
+        (new_expiration_date, category, classname, "due", 1),
+    ])
+
+
+def rebuild_rollups(session):
+    """recomputes all rollups from the borrowing history, e.g. for a
+    database that was created before the rollups existed"""
+    # loans recorded before they kept their groups fall back to the
+    # current category of the book and class of the user
+    category = functions.coalesce(
+        BorrowingUserTable.category, BookTable.category, "")
+    classname = functions.coalesce(
+        BorrowingUserTable.classname, UserTable.classname, "")
+    loans = session.query(BorrowingUserTable).outerjoin(
+        BookTable
+    ).outerjoin(
+        UserTable
+    )
+    totals = defaultdict(Counter)
+    for column, day, condition in [
+        ("started", BorrowingUserTable.start_date, None),
+        ("returned", BorrowingUserTable.return_date,
+         BorrowingUserTable.return_date != None),
+        ("due", BorrowingUserTable.expiration_date, None),
+        ("returned_in_time", BorrowingUserTable.expiration_date,
+         BorrowingUserTable.return_date <= BorrowingUserTable.expiration_date),
+    ]:
+        query = loans.with_entities(
+            day, category, classname, functions.count(BorrowingUserTable.key)
+        )
+        if condition is not None:
+            query = query.filter(condition)
+        for row_day, row_category, row_classname, count in query.group_by(
+            day, category, classname
+        ):
+            totals[(row_day, row_category, row_classname)][column] = count
+    session.query(LoanRollupTable).delete(synchronize_session=False)
+    if totals:
+        session.execute(LoanRollupTable.__table__.insert(), [
+            {
+                "day": day,
+                "category": category,
+                "classname": classname,
+                **{column: counts[column] for column in ROLLUP_COLUMNS},
+            }
+            for (day, category, classname), counts in totals.items()
+        ])
+    logger.info(f"rebuilt {len(totals)} loan rollups")
+
+
+def rollups_missing(session) -> bool:
+    """checks whether there are loans but no rollups yet"""
+    return (
+        session.query(LoanRollupTable).first() is None
+        and session.query(BorrowingUserTable).first() is not None
+    )
+
+
+def loan_statistics(
+        session, start: date, end: date, group_by: LoanStatisticsGrouping):
+    """returns the number of loans started, returned and overdue between
+    `start` and `end` (both inclusive) grouped by `group_by`. Loans are
+    counted as overdue on the day they were due, once that day has passed"""
+    group = GROUP_COLUMNS[group_by]
+    today = datetime.now().date()
+    rows = session.query(
+        group,
+        functions.sum(LoanRollupTable.started),
+        functions.sum(LoanRollupTable.returned),
+        functions.sum(sqlalchemy.case(
+            [(
+                LoanRollupTable.day < today,
+                LoanRollupTable.due - LoanRollupTable.returned_in_time
+            )],
+            else_=0
+        )),
+    ).filter(
+        LoanRollupTable.day.between(start, end)
+    ).group_by(group).order_by(group).all()
+    return [
+        {
+            "group": str(group_value),
+            "started": started,
+            "returned": returned,
+            "overdue": overdue,
+        }
+        for group_value, started, returned, overdue in rows
+    ]
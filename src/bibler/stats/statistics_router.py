@@ -1,15 +1,19 @@
 
 
-import datetime
 import logging
+from datetime import date, datetime
+from typing import List, Optional
 
-from fastapi import APIRouter
-from sqlalchemy.sql import functions
+from dateutil.relativedelta import relativedelta
+from fastapi import APIRouter, Depends
 
-from ..dataclasses.Book import BookTable
-from ..dataclasses.BorrowingUser import BorrowingUserTable
-from ..dataclasses.User import UserTable
-from ..db.repository import Session
+from ..db.query_cache import query_cache
+from ..db.repository import get_pool_status, get_session
+from ..responses.LoanStatisticsResponse import LoanStatisticsRecord
+from ..responses.StatisticsSummaryResponse import \
+    StatisticsSummaryResponseModel
+from .counters import counters
+from .rollups import LoanStatisticsGrouping, loan_statistics, rebuild_rollups
 
 stats = APIRouter()
 
@@ -18,36 +22,71 @@ logger.setLevel(logging.INFO)
 
 
 @stats.get("/stats/books/borrowed")
-async def get_borrowed_count():
+def get_borrowed_count():
     """returns the number of currently borrowed books"""
-    session = Session()
-    count = session.query(functions.count(BorrowingUserTable.key)).filter(
-        BorrowingUserTable.return_date == None
-    ).all()
-    return count[0][0]
+    return counters.borrowed()
 
 
 @stats.get("/stats/books/overdue")
-async def get_overdue_count():
+def get_overdue_count():
     """returns the number of books that are overdue"""
-    session = Session()
-    count = session.query(functions.count(BorrowingUserTable.key)).filter(
-        BorrowingUserTable.expiration_date < datetime.now().date()
-    ).all()
-    return count[0][0]
+    return counters.overdue()
 
 
 @stats.get("/stats/books/count")
-async def get_books_count():
+def get_books_count():
     """return number of books"""
-    session = Session()
-    count = session.query(functions.count(BookTable.key)).all()
-    return count[0][0]
+    return counters.count_books()
 
 
 @stats.get("/stats/users/count")
-async def get_users_count():
+def get_users_count():
     """return number of users"""
-    session = Session()
-    count = session.query(functions.count(UserTable.key)).all()
-    return count[0][0]
+    return counters.count_users()
+
+
+@stats.get("/summary", response_model=StatisticsSummaryResponseModel)
+def get_summary():
+    """returns all statistics counters in one response"""
+    return counters.summary()
+
+
+@stats.post("/recount", response_model=StatisticsSummaryResponseModel)
+def recount(session=Depends(get_session)):
+    """counts all statistics again from the database"""
+    counters.recount(session)
+    return counters.summary()
+
+
+@stats.get("/loans", response_model=List[LoanStatisticsRecord])
+def get_loan_statistics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    group_by: LoanStatisticsGrouping = LoanStatisticsGrouping.day,
+    session=Depends(get_session),
+):
+    """returns the number of loans started, returned and overdue between
+    `start` and `end` grouped by day, week, month, category or class. The
+    range defaults to the four weeks up to today"""
+    end = end or datetime.now().date()
+    start = start or end - relativedelta(weeks=4)
+    return loan_statistics(session, start, end, group_by)
+
+
+@stats.post("/loans/rebuild")
+def rebuild_loan_statistics(session=Depends(get_session)):
+    """recomputes the daily loan rollups from the borrowing history"""
+    rebuild_rollups(session)
+    session.commit()
+
+
+@stats.get("/pool")
+def get_pool():
+    """returns the usage of the database connection pool"""
+    return get_pool_status()
+
+
+@stats.get("/cache")
+def get_cache():
+    """returns the hit and miss counters of the query cache"""
+    return query_cache.get_metrics()
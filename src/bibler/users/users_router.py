@@ -2,13 +2,14 @@ import logging
 from typing import List
 
 import sqlalchemy
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Query
 from sqlalchemy.sql import functions
 
 from ..dataclasses.Book import BookTable
 from ..dataclasses.BorrowingUser import BorrowingUserTable
 from ..dataclasses.User import User, UserIn, UserTable
-from ..db.repository import Session
+from ..db.query_cache import LOANS, USERS, query_cache
+from ..db.repository import get_session
 from ..responses.BorrowingUsersResponse import BorrowingUserRecord
 from ..responses.DeleteUserResponse import (DeleteUserResponseModel,
                                             DeleteUserResponseStatus)
@@ -16,6 +17,8 @@ from ..responses.PatchUserResponse import (PatchUserResponseModel,
                                            PatchUserResponseStatus)
 from ..responses.PutUserResponse import (PutUserResponseModel,
                                          PutUserResponseStatus)
+from ..search import typeahead
+from ..stats.counters import counters
 
 users = APIRouter()
 
@@ -24,9 +27,13 @@ logger.setLevel(logging.INFO)
 
 
 @users.get("/")
-async def get_users():
+def get_users(session=Depends(get_session)):
     """returns a list of users and the amount of books that they have borrowed"""
-    session: Session = Session()
+    return query_cache.get(("users",), (USERS, LOANS), lambda: query_users(session))
+
+
+def query_users(session):
+    """returns pairs of a user and the number of books borrowed by the user"""
     count_table = session.query(
         BorrowingUserTable.user_key,
         functions.count(
@@ -37,7 +44,7 @@ async def get_users():
         BorrowingUserTable.user_key
     ).subquery()
     ret = session.query(
-        UserTable,
+        *UserTable.__table__.columns,
         functions.coalesce(
             count_table.c.borrowed_books, 0
         ).label("borrowed_books")
@@ -50,63 +57,94 @@ async def get_users():
         UserTable.classname
     ).all()
     logger.info(ret)
-    return ret
+    return [
+        [
+            {
+                "key": i.key,
+                "firstname": i.firstname,
+                "lastname": i.lastname,
+                "classname": i.classname,
+            },
+            i.borrowed_books
+        ]
+        for i in ret
+    ]
 
 
 @users.put("/", response_model=PutUserResponseModel)
-async def put_user(user: UserIn):
+def put_user(user: UserIn, session=Depends(get_session)):
     """inserts a new user `user` into the list of existing users"""
     try:
-        session = Session()
-        session.add(UserTable(user))
+        new_user = UserTable(user)
+        session.add(new_user)
         session.commit()
     except sqlalchemy.exc.IntegrityError:
+        session.rollback()
         return {"status": PutUserResponseStatus.fail}
+    counters.users_added()
+    typeahead.add_users([new_user])
+    query_cache.invalidate(USERS)
     return {"status": PutUserResponseStatus.success}
 
 
 @users.patch("/user", response_model=PatchUserResponseModel)
-async def patch_user(user: User):
+def patch_user(user: User, session=Depends(get_session)):
     """update a `user` in the list of users"""
     try:
-        session = Session()
         selected_user = session.query(
             UserTable
         ).filter(
             UserTable.key == user.key
         ).first()
+        if selected_user is None:
+            return {"status": PatchUserResponseStatus.fail}
         selected_user.firstname = user.firstname
         selected_user.lastname = user.lastname
         selected_user.classname = user.classname
         session.commit()
     except sqlalchemy.exc.IntegrityError:
+        session.rollback()
         return {"status": PatchUserResponseStatus.fail}
+    typeahead.add_users([selected_user])
+    query_cache.invalidate(USERS)
     return {"status": PatchUserResponseStatus.success}
 
 
 @users.delete("/user/{user_key}", response_model=DeleteUserResponseModel)
-async def delete_user(user_key: int):
+def delete_user(user_key: int, session=Depends(get_session)):
     """delete a `user` in the list of users"""
     try:
-        session = Session()
         if session.query(BorrowingUserTable).filter(
-            BorrowingUserTable.return_date != None,
+            BorrowingUserTable.return_date == None,
             BorrowingUserTable.user_key == user_key
         ).first() is not None:
             return {"status": DeleteUserResponseStatus.borrowing}
         selected_user = session.query(UserTable).filter(
             UserTable.key == user_key).first()
+        if selected_user is None:
+            return {"status": DeleteUserResponseStatus.fail}
         session.delete(selected_user)
         session.commit()
     except sqlalchemy.exc.IntegrityError:
+        session.rollback()
         return {"status": DeleteUserResponseStatus.fail}
+    counters.users_removed()
+    typeahead.users_typeahead.remove(user_key)
+    query_cache.invalidate(USERS)
     return {"status": DeleteUserResponseStatus.success}
 
 
+@users.get("/typeahead")
+def typeahead_users(q: str, limit: int = Query(10, ge=1, le=100)):
+    """returns key, firstname, lastname and classname of up to `limit`
+    users with a word in their name or class starting with every word of
+    `q`"""
+    return typeahead.users_typeahead.search(q, limit)
+
+
 @users.get("/borrowing", response_model=List[BorrowingUserRecord])
-async def get_borrowing_users():
+def get_borrowing_users(session=Depends(get_session)):
     """returns a list of all Books together with the user that borrows it"""
-    session = Session()
     ret = session.query(
         BorrowingUserTable.key,
         BorrowingUserTable.book_key,
@@ -1,42 +1,100 @@
 
 import logging
+from collections import Counter
 from datetime import datetime
 from typing import Any, List, Optional
 
+import sqlalchemy
 from dateutil.relativedelta import relativedelta
+from fastapi import Depends
 from fastapi.routing import APIRouter
+from sqlalchemy.sql import functions
 
 from ..dataclasses.Book import BookTable
-from ..dataclasses.BorrowingUser import BorrowingUser, BorrowingUserTable
+from ..dataclasses.BorrowingUser import (BorrowingRequest, BorrowingUser,
+                                         BorrowingUserTable)
 from ..dataclasses.User import UserTable
-from ..db.repository import Session
+from ..db.query_cache import LOANS, query_cache
+from ..db.repository import chunks, get_session
+from ..responses.BatchBorrowResponse import BatchBorrowResponseRecord
+from ..responses.BatchReturningResponse import BatchReturningResponseRecord
 from ..responses.BorrowResponse import (BorrowResponseModel,
                                         BorrowResponseStatus)
 from ..responses.ExtendingResponse import (ExtendingResponseModel,
                                            ExtendingResponseStatus)
 from ..responses.ReturningResponse import (ReturningResponseModel,
                                            ReturningResponseStatus)
+from ..stats import rollups
+from ..stats.counters import counters
 
 logger = logging.getLogger("Bibler-server")
 logger.setLevel(logging.INFO)
 workflows = APIRouter()
+# how often a batch is revalidated if it collides with concurrent requests
+BATCH_ATTEMPTS = 3
+
+
+def lookup_loan(session, user_key: int, book_key: int):
+    """fetches everything the workflows need to decide on a request in a
+    single statement: whether the user with the key `user_key` and the book
+    with the key `book_key` exist, whether the book is currently borrowed
+    by anyone, the open loan of the book by the user, if there is one, the
+    current category of the book and class of the user and the ones the
+    open loan was recorded under for the rollups"""
+    open_loans = session.query(BorrowingUserTable).filter(
+        BorrowingUserTable.book_key == book_key
+    ).filter(
+        BorrowingUserTable.return_date == None
+    )
+    user_loan = open_loans.filter(
+        BorrowingUserTable.user_key == user_key
+    ).limit(1)
+    category = session.query(BookTable.category).filter(
+        BookTable.key == book_key
+    ).as_scalar()
+    classname = session.query(UserTable.classname).filter(
+        UserTable.key == user_key
+    ).as_scalar()
+    return session.query(
+        session.query(UserTable).filter(
+            UserTable.key == user_key
+        ).exists().label("user_exists"),
+        session.query(BookTable).filter(
+            BookTable.key == book_key
+        ).exists().label("book_exists"),
+        open_loans.exists().label("borrowed"),
+        user_loan.with_entities(
+            BorrowingUserTable.key
+        ).as_scalar().label("loan_key"),
+        user_loan.with_entities(
+            BorrowingUserTable.start_date
+        ).as_scalar().label("start_date"),
+        user_loan.with_entities(
+            BorrowingUserTable.expiration_date
+        ).as_scalar().label("expiration_date"),
+        category.label("category"),
+        classname.label("classname"),
+        # the groups the open loan was recorded under when it started
+        user_loan.with_entities(
+            functions.coalesce(BorrowingUserTable.category, category)
+        ).as_scalar().label("loan_category"),
+        user_loan.with_entities(
+            functions.coalesce(BorrowingUserTable.classname, classname)
+        ).as_scalar().label("loan_classname"),
+    ).one()
 
 
 @workflows.patch("/borrow/{user_key}/{book_key}", response_model=BorrowResponseModel)
-async def borrow_book(user_key: int, book_key: int, duration: int = 3):
+def borrow_book(user_key: int, book_key: int, duration: int = 3, session=Depends(get_session)):
     """borrow a book with the key `book_key` for the user `user_key`"""
-    session = Session()
-    if session.query(UserTable).filter(UserTable.key == user_key).first() is None:
+    loan = lookup_loan(session, user_key, book_key)
+    if not loan.user_exists:
         logger.error(f"User with key:{user_key} does not exist")
         return {"status": BorrowResponseStatus.user_unknown}
-    if session.query(BookTable).filter(BookTable.key == book_key).first() is None:
+    if not loan.book_exists:
         logger.error(f"Book with key:{book_key} does not exist")
         return {"status": BorrowResponseStatus.book_unknown}
-    if session.query(BorrowingUserTable).filter(
-        BorrowingUserTable.book_key == book_key
-    ).filter(
-            BorrowingUserTable.return_date == None
-    ).first() is not None:
+    if loan.borrowed:
         logger.error(f"Book is already borrowed")
         return {"status": BorrowResponseStatus.already_borrowed}
     current_date = datetime.now()
@@ -48,11 +106,24 @@ async def borrow_book(user_key: int, book_key: int, duration: int = 3):
         user_key=user_key,
         start_date=current_date.date(),
         expiration_date=expiration_date,
-        return_date=None
+        return_date=None,
+        category=loan.category or "",
+        classname=loan.classname or "",
     )))
+    rollups.loans_started(session, [(
+        loan.category, loan.classname, current_date.date(), expiration_date
+    )])
     logger.info(
         f"user: {user_key} is borrowing {book_key} at {current_date} until {expiration_date}")
-    session.commit()
+    try:
+        session.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # someone else borrowed the book between the lookup and the insert
+        session.rollback()
+        logger.error(f"Book is already borrowed")
+        return {"status": BorrowResponseStatus.already_borrowed}
+    counters.loan_started(expiration_date)
+    query_cache.invalidate(LOANS)
     return {
         "status": BorrowResponseStatus.success,
         "return_date": expiration_date
@@ -60,71 +131,247 @@ async def borrow_book(user_key: int, book_key: int, duration: int = 3):
 
 
 @workflows.patch("/return/{user_key}/{book_key}", response_model=ReturningResponseModel)
-async def return_book(user_key: int, book_key: int):
+def return_book(user_key: int, book_key: int, session=Depends(get_session)):
     """return a book with the key `book_key` as the user with the key `user_key`"""
-    session = Session()
-    if session.query(UserTable).filter(UserTable.key == user_key).first() is None:
+    loan = lookup_loan(session, user_key, book_key)
+    if not loan.user_exists:
         logger.error(f"User with key:{user_key} does not exist")
         return {"status": ReturningResponseStatus.user_unknown}
-    if session.query(BookTable).filter(BookTable.key == book_key).first() is None:
+    if not loan.book_exists:
         logger.error(f"Book with key:{book_key} does not exist")
         return {"status": ReturningResponseStatus.book_unknown}
-    if session.query(BorrowingUserTable).filter(
-        BorrowingUserTable.book_key == book_key
-    ).filter(
-        BorrowingUserTable.return_date == None
-    ).first() is None:
+    if not loan.borrowed:
         logger.error(f"Book is not lend to anyone")
         return {"status": ReturningResponseStatus.book_not_borrowed}
-    return_record = session.query(BorrowingUserTable).filter(
-        BorrowingUserTable.book_key == book_key
-    ).filter(
-        BorrowingUserTable.user_key == user_key
-    ).filter(
-        BorrowingUserTable.return_date == None
-    ).first()
-    if return_record is None:
+    if loan.loan_key is None:
         logger.error(
             f"Book with id '{book_key}' is not lend to user with id '{user_key}''")
         return {"status": ReturningResponseStatus.book_not_borrowed}
-    return_record.return_date = datetime.now().date()
+    return_date = datetime.now().date()
+    # the update only closes the loan if it is still open, so of two
+    # concurrent returns only the first one changes a row
+    updated = session.query(BorrowingUserTable).filter(
+        BorrowingUserTable.key == loan.loan_key
+    ).filter(
+        BorrowingUserTable.return_date == None
+    ).update(
+        {BorrowingUserTable.return_date: return_date},
+        synchronize_session=False
+    )
+    if updated != 1:
+        session.rollback()
+        logger.error(f"Loan {loan.loan_key} was returned concurrently")
+        return {"status": ReturningResponseStatus.book_not_borrowed}
+    rollups.loans_returned(
+        session,
+        [(loan.loan_category, loan.loan_classname, loan.expiration_date)],
+        return_date
+    )
     session.commit()
+    counters.loan_ended(loan.expiration_date)
+    query_cache.invalidate(LOANS)
     return {"status": ReturningResponseStatus.success}
 
 
 @workflows.patch("/extend/{user_key}/{book_key}", response_model=ExtendingResponseModel)
-async def extend_borrow_period(user_key: int, book_key: int, duration: int = 1):
+def extend_borrow_period(user_key: int, book_key: int, duration: int = 1, session=Depends(get_session)):
     """extend the borrowing period for a a book with the key `book_key` for the user with the key `user_key`"""
-    session = Session()
-    if session.query(UserTable).filter(UserTable.key == user_key).first() is None:
+    loan = lookup_loan(session, user_key, book_key)
+    if not loan.user_exists:
         logger.error(f"User with key:{user_key} does not exist")
         return {"status": ExtendingResponseStatus.user_unknown}
-    if session.query(BookTable).filter(BookTable.key == book_key).first() is None:
+    if not loan.book_exists:
         logger.error(f"Book with key:{book_key} does not exist")
         return {"status": ExtendingResponseStatus.book_unknown}
-    if session.query(BorrowingUserTable).filter(
-        BorrowingUserTable.book_key == book_key
-    ).filter(
-        BorrowingUserTable.return_date == None
-    ).first() is None:
+    if not loan.borrowed:
         logger.error(f"Book is not lend to anyone")
         return {"status": ExtendingResponseStatus.book_not_borrowed}
-    extend_record = session.query(BorrowingUserTable).filter(
-        BorrowingUserTable.book_key == book_key
-    ).filter(
-        BorrowingUserTable.user_key == user_key
-    ).filter(
-        BorrowingUserTable.return_date == None
-    ).first()
-    if extend_record is None:
+    if loan.loan_key is None:
         logger.error(
             f"Book with id '{book_key}' is not lend to user with id '{user_key}'")
         return {"status": ExtendingResponseStatus.book_not_borrowed}
-    new_expiration_date = (extend_record.expiration_date +
+    new_expiration_date = (loan.expiration_date +
                            relativedelta(weeks=duration))
-    if (extend_record.start_date + relativedelta(weeks=5)) < new_expiration_date:
+    if (loan.start_date + relativedelta(weeks=5)) < new_expiration_date:
         logger.info(f"Book can't be extended to loger than 5 weeks")
         return {"status": ExtendingResponseStatus.limit_exceeded}
-    extend_record.expiration_date = new_expiration_date
+    # the update only applies to the loan as it was looked up, so of two
+    # concurrent extensions only the first one changes a row
+    updated = session.query(BorrowingUserTable).filter(
+        BorrowingUserTable.key == loan.loan_key
+    ).filter(
+        BorrowingUserTable.return_date == None
+    ).filter(
+        BorrowingUserTable.expiration_date == loan.expiration_date
+    ).update(
+        {BorrowingUserTable.expiration_date: new_expiration_date},
+        synchronize_session=False
+    )
+    if updated != 1:
+        session.rollback()
+        logger.error(f"Loan {loan.loan_key} was changed concurrently")
+        return {"status": ExtendingResponseStatus.book_not_borrowed}
+    rollups.loan_extended(
+        session, loan.loan_category, loan.loan_classname,
+        loan.expiration_date, new_expiration_date)
     session.commit()
+    counters.loan_extended(loan.expiration_date, new_expiration_date)
+    query_cache.invalidate(LOANS)
     return {"status": ExtendingResponseStatus.success, "return_date": new_expiration_date}
+
+
+def values_by_key(session, key_column, value_column, keys):
+    """returns a mapping from the `keys` that exist in `key_column` to the
+    value of `value_column` of their row"""
+    keys = list(set(keys))
+    return {
+        key: value
+        for chunk in chunks(keys)
+        for key, value in session.query(key_column, value_column).filter(
+            key_column.in_(chunk)
+        )
+    }
+
+
+def open_loans_by_book(session, book_keys):
+    """returns the open loans of the books `book_keys` as a mapping from the
+    book key to the loan key, the key of the borrowing user, the expiration
+    date and the category and class the loan was recorded under"""
+    book_keys = list(set(book_keys))
+    return {
+        book_key: (key, user_key, expiration_date, category, classname)
+        for chunk in chunks(book_keys)
+        for key, book_key, user_key, expiration_date, category, classname in session.query(
+            BorrowingUserTable.key,
+            BorrowingUserTable.book_key,
+            BorrowingUserTable.user_key,
+            BorrowingUserTable.expiration_date,
+            functions.coalesce(BorrowingUserTable.category, BookTable.category),
+            functions.coalesce(BorrowingUserTable.classname, UserTable.classname),
+        ).outerjoin(
+            BookTable, BookTable.key == BorrowingUserTable.book_key
+        ).outerjoin(
+            UserTable, UserTable.key == BorrowingUserTable.user_key
+        ).filter(
+            BorrowingUserTable.book_key.in_(chunk)
+        ).filter(
+            BorrowingUserTable.return_date == None
+        )
+    }
+
+
+def try_borrow_books(session, loans: List[BorrowingRequest], duration: int):
+    """validates all `loans` with set based queries and inserts the valid
+    ones in one statement"""
+    users = values_by_key(
+        session, UserTable.key, UserTable.classname, [i.user_key for i in loans])
+    books = values_by_key(
+        session, BookTable.key, BookTable.category, [i.book_key for i in loans])
+    borrowed = set(open_loans_by_book(
+        session, [i.book_key for i in loans]))
+    current_date = datetime.now()
+    expiration_date = (
+        current_date + relativedelta(weeks=duration)).date()
+    records = []
+    rows = []
+    started = []
+    for loan in loans:
+        record = {"user_key": loan.user_key, "book_key": loan.book_key}
+        if loan.user_key not in users:
+            record["status"] = BorrowResponseStatus.user_unknown
+        elif loan.book_key not in books:
+            record["status"] = BorrowResponseStatus.book_unknown
+        elif loan.book_key in borrowed:
+            record["status"] = BorrowResponseStatus.already_borrowed
+        else:
+            borrowed.add(loan.book_key)
+            record["status"] = BorrowResponseStatus.success
+            record["return_date"] = expiration_date
+            rows.append({
+                "user_key": loan.user_key,
+                "book_key": loan.book_key,
+                "start_date": current_date.date(),
+                "expiration_date": expiration_date,
+                "return_date": None,
+                "category": books[loan.book_key] or "",
+                "classname": users[loan.user_key] or "",
+            })
+            started.append((
+                books[loan.book_key], users[loan.user_key],
+                current_date.date(), expiration_date
+            ))
+        records.append(record)
+    if rows:
+        session.execute(BorrowingUserTable.__table__.insert(), rows)
+        rollups.loans_started(session, started)
+    session.commit()
+    counters.loan_started(expiration_date, len(rows))
+    query_cache.invalidate(LOANS)
+    return records
+
+
+@workflows.post("/borrow/batch", response_model=List[BatchBorrowResponseRecord])
+def borrow_books(loans: List[BorrowingRequest], duration: int = 3, session=Depends(get_session)):
+    """borrow several books at once, e.g. for a whole class. Returns the
+    status for every requested loan in the order of the request"""
+    for attempt in range(BATCH_ATTEMPTS):
+        try:
+            records = try_borrow_books(session, loans, duration)
+            break
+        except sqlalchemy.exc.IntegrityError:
+            # a concurrent request borrowed one of the books after the
+            # validation, validate again so it is reported as borrowed
+            session.rollback()
+            if attempt == BATCH_ATTEMPTS - 1:
+                raise
+    logger.info(
+        f"borrowed {sum(i['status'] == BorrowResponseStatus.success for i in records)} of {len(loans)} books")
+    return records
+
+
+@workflows.post("/return/batch", response_model=List[BatchReturningResponseRecord])
+def return_books(loans: List[BorrowingRequest], session=Depends(get_session)):
+    """return several books at once. Returns the status for every
+    requested return in the order of the request"""
+    users = values_by_key(
+        session, UserTable.key, UserTable.classname, [i.user_key for i in loans])
+    books = values_by_key(
+        session, BookTable.key, BookTable.category, [i.book_key for i in loans])
+    open_loans = open_loans_by_book(session, [i.book_key for i in loans])
+    return_date = datetime.now().date()
+    table = BorrowingUserTable.__table__
+    records = []
+    ended = []
+    for loan in loans:
+        record = {"user_key": loan.user_key, "book_key": loan.book_key}
+        loan_key, user_key, expiration_date, category, classname = open_loans.get(
+            loan.book_key, (None, None, None, None, None))
+        if loan.user_key not in users:
+            record["status"] = ReturningResponseStatus.user_unknown
+        elif loan.book_key not in books:
+            record["status"] = ReturningResponseStatus.book_unknown
+        elif user_key != loan.user_key:
+            record["status"] = ReturningResponseStatus.book_not_borrowed
+        elif session.execute(
+            # a loan returned concurrently since the lookup is not changed
+            # again, so the rowcount tells which loans this request closed
+            table.update().where(
+                sqlalchemy.and_(
+                    table.c.key == loan_key,
+                    table.c.return_date == None,
+                )
+            ).values(return_date=return_date)
+        ).rowcount != 1:
+            record["status"] = ReturningResponseStatus.book_not_borrowed
+        else:
+            del open_loans[loan.book_key]
+            ended.append((category, classname, expiration_date))
+            record["status"] = ReturningResponseStatus.success
+        records.append(record)
+    rollups.loans_returned(session, ended, return_date)
+    session.commit()
+    for expiration_date, count in Counter(i[2] for i in ended).items():
+        counters.loan_ended(expiration_date, count)
+    query_cache.invalidate(LOANS)
+    logger.info(f"returned {len(ended)} of {len(loans)} books")
+    return records
@@ -1,15 +1,36 @@
+import asyncio
+import io
 import json
 import logging
 import os
-from datetime import datetime
+import time
+from datetime import date, datetime
+from types import SimpleNamespace
 
 import bibler.biblerAPI as biblerAPI
 import pandas as pd
+import pyarrow.ipc
+import pyarrow.parquet
 import pytest
+import sqlalchemy
 from bibler.biblerAPI import Session, bibler
-from bibler.dataclasses.BorrowingUser import BorrowingUser
+from bibler.books.fuzzy import book_trigrams
+from bibler.dataclasses.Book import Book, BookTable
+from bibler.dataclasses.BookTrigram import BookTrigramTable
+from bibler.dataclasses.BorrowingUser import BorrowingUser, BorrowingUserTable
+from bibler.dataclasses.ImportJob import ImportJobTable
+from bibler.dataclasses.model import Base
+from bibler.dataclasses.User import User, UserTable
+from bibler.db.migrations import migrate
+from bibler.db.query_cache import INCREMENT_GENERATION, USERS
+from bibler.files import importer
+from bibler.media import uploads
+from bibler.media.thumbnails import ThumbnailCache, thumbnails
+from bibler.stats.counters import STATISTICS
+from bibler.workflows import workflows_router
 from dateutil.relativedelta import relativedelta
 from fastapi.testclient import TestClient
+from PIL import Image
 from requests.sessions import session
 from starlette import responses
 
@@ -430,3 +451,1005 @@ def test_return_book_as_wrong_user(uut: TestClient, tmpdir, caplog):
     assert response.json() == {
         "status": "book not borrowed",
     }
+
+
+def test_get_books_paginated(uut: TestClient, caplog):
+    """test that paging through the books with `after_key` returns every
+    matching book exactly once in the requested order"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    session.add_all([
+        BookTable(Book(
+            key=-1,
+            title=f"Paging {i % 3}",
+            author="Pager",
+            publisher="Carlsen",
+            number=str(9000 + i),
+            shorthand="Car",
+            category="Paging",
+        ))
+        for i in range(7)
+    ])
+    session.commit()
+    # when
+    pages = [uut.get("/books/?category=Paging&sort_by=title&limit=3")]
+    while "x-next-after-key" in pages[-1].headers:
+        pages.append(uut.get(
+            "/books/?category=Paging&sort_by=title&limit=3"
+            f"&after_key={pages[-1].headers['x-next-after-key']}"
+        ))
+    # then
+    books = [book for page in pages for book in page.json()]
+    assert pages[0].headers["x-total-count"] == "7"
+    assert len(books) == 7
+    assert [book["title"] for book in books] == sorted(
+        book["title"] for book in books)
+
+
+def test_borrow_books_batch(uut: TestClient, caplog):
+    """test that a batch borrowing request reports a status for every
+    requested book and borrows every book at most once"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    user = UserTable(User(key=-1, firstname="Batch",
+                          lastname="Borrower", classname="2b"))
+    books = [
+        BookTable(Book(
+            key=-1,
+            title=f"Batch {i}",
+            author="Batcher",
+            publisher="Carlsen",
+            number=str(9100 + i),
+            shorthand="Car",
+            category="Batch",
+        ))
+        for i in range(2)
+    ]
+    session.add_all([user, *books])
+    session.commit()
+    # when
+    response = uut.post("/workflows/borrow/batch", json=[
+        {"user_key": user.key, "book_key": books[0].key},
+        {"user_key": user.key, "book_key": books[1].key},
+        {"user_key": user.key, "book_key": books[1].key},
+    ])
+    # then
+    assert [i["status"] for i in response.json()] == [
+        "successfully borrowed",
+        "successfully borrowed",
+        "already borrowed",
+    ]
+
+
+def test_return_books_batch(uut: TestClient, caplog):
+    """test that a batch returning request only returns the open loans and
+    reports the already returned books as not borrowed"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    user = UserTable(User(key=-1, firstname="Batch",
+                          lastname="Returner", classname="2c"))
+    books = [
+        BookTable(Book(
+            key=-1,
+            title=f"Batch return {i}",
+            author="Batcher",
+            publisher="Carlsen",
+            number=str(9150 + i),
+            shorthand="Car",
+            category="Batch return",
+        ))
+        for i in range(2)
+    ]
+    session.add_all([user, *books])
+    session.commit()
+    for book in books:
+        uut.patch(f"/workflows/borrow/{user.key}/{book.key}")
+    uut.patch(f"/workflows/return/{user.key}/{books[0].key}")
+    before = uut.get("/stats/loans?group_by=category").json()
+    # when
+    response = uut.post("/workflows/return/batch", json=[
+        {"user_key": user.key, "book_key": books[0].key},
+        {"user_key": user.key, "book_key": books[1].key},
+        {"user_key": user.key, "book_key": books[1].key},
+    ])
+    after = uut.get("/stats/loans?group_by=category").json()
+    # then
+    assert [i["status"] for i in response.json()] == [
+        "book not borrowed",
+        "successfully returned",
+        "book not borrowed",
+    ]
+    assert {"group": "Batch return", "started": 2, "returned": 1,
+            "overdue": 0} in before
+    assert {"group": "Batch return", "started": 2, "returned": 2,
+            "overdue": 0} in after
+    uut.post("/stats/loans/rebuild")
+    assert after == uut.get("/stats/loans?group_by=category").json()
+
+
+def test_stats_summary_is_kept_up_to_date(uut: TestClient, caplog):
+    """test that the cached statistics follow the write endpoints and
+    match a fresh count from the database"""
+    # given
+    caplog.set_level(logging.INFO)
+    before = uut.post("/stats/recount").json()
+    # when
+    uut.put("/users/", json={
+        "firstname": "Stat",
+        "lastname": "Counter",
+        "classname": "3c",
+    })
+    response = uut.get("/stats/summary")
+    # then
+    assert response.json()["users"] == before["users"] + 1
+    assert response.json() == uut.post("/stats/recount").json()
+
+
+def test_loan_statistics_match_rebuilt_rollups(uut: TestClient, caplog):
+    """test that the incrementally maintained loan rollups are the same as
+    the rollups rebuilt from the borrowing history"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    user = UserTable(User(key=-1, firstname="Roll",
+                          lastname="Up", classname="4d"))
+    book = BookTable(Book(
+        key=-1,
+        title="Rollup",
+        author="Roller",
+        publisher="Carlsen",
+        number="9200",
+        shorthand="Car",
+        category="Rollup",
+    ))
+    session.add_all([user, book])
+    session.commit()
+    # when
+    uut.patch(f"/workflows/borrow/{user.key}/{book.key}")
+    uut.patch(f"/workflows/extend/{user.key}/{book.key}")
+    uut.patch(f"/workflows/return/{user.key}/{book.key}")
+    response = uut.get("/stats/loans?group_by=classname")
+    uut.post("/stats/loans/rebuild")
+    # then
+    assert {"group": "4d", "started": 1, "returned": 1,
+            "overdue": 0} in response.json()
+    assert response.json() == uut.get("/stats/loans?group_by=classname").json()
+
+
+def test_loan_statistics_keep_the_class_the_loan_started_in(uut: TestClient, caplog):
+    """test that a loan is returned in the class it was borrowed in when
+    the class of the user changes in between"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    user = UserTable(User(key=-1, firstname="Class",
+                          lastname="Changer", classname="5c"))
+    book = BookTable(Book(
+        key=-1,
+        title="Promotion",
+        author="Roller",
+        publisher="Carlsen",
+        number="9960",
+        shorthand="Car",
+        category="Rollup",
+    ))
+    session.add_all([user, book])
+    session.commit()
+    uut.patch(f"/workflows/borrow/{user.key}/{book.key}")
+    before = {i["group"]: i for i in uut.get(
+        "/stats/loans?group_by=classname").json()}
+    # when
+    uut.patch("/users/user", json={
+        "key": user.key,
+        "firstname": "Class",
+        "lastname": "Changer",
+        "classname": "6c",
+    })
+    uut.patch(f"/workflows/return/{user.key}/{book.key}")
+    response = uut.get("/stats/loans?group_by=classname")
+    uut.post("/stats/loans/rebuild")
+    # then
+    after = {i["group"]: i for i in response.json()}
+    assert after["5c"]["returned"] == before["5c"]["returned"] + 1
+    assert after.get("6c") == before.get("6c")
+    assert response.json() == uut.get("/stats/loans?group_by=classname").json()
+
+
+def test_get_book_cover_not_modified(uut: TestClient, caplog):
+    """test that a cover is answered with 304 if the client already has
+    the current version"""
+    # given
+    caplog.set_level(logging.INFO)
+    os.makedirs("data/media", exist_ok=True)
+    path = os.path.join("data/media", "9300.png")
+    with open(path, "wb") as f:
+        f.write(b"cover")
+    try:
+        etag = uut.get("/media/9300").headers["etag"]
+        # when
+        response = uut.get("/media/9300", headers={"If-None-Match": etag})
+    finally:
+        os.remove(path)
+    # then
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+def test_search_books(uut: TestClient, caplog):
+    """test that the full text search finds a new book by the beginning of
+    a word of its title, ignoring umlauts"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put("/books/", json={
+        "key": -1,
+        "title": "Die Brüder Löwenherz",
+        "author": "Astrid Lindgren",
+        "publisher": "Oetinger",
+        "number": "9400",
+        "shorthand": "Oet",
+        "category": "Fantasy",
+    })
+    # when
+    response = uut.get("/books/search", params={"q": "lowen lindgren"})
+    # then
+    assert response.headers["X-Total-Count"] == "1"
+    assert response.json()[0]["title"] == "Die Brüder Löwenherz"
+
+
+def test_fuzzy_search_books(uut: TestClient, caplog):
+    """test that the fuzzy search finds a book despite a misspelled and
+    unfolded umlaut"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put("/books/", json={
+        "key": -1,
+        "title": "Das kleine Gespenst",
+        "author": "Otfried Preußler",
+        "publisher": "Thienemann",
+        "number": "9500",
+        "shorthand": "Thi",
+        "category": "Fantasy",
+    })
+    # when
+    response = uut.get(
+        "/books/search", params={"q": "Gespennst Preussler", "mode": "fuzzy"})
+    # then
+    assert response.json()[0]["title"] == "Das kleine Gespenst"
+    assert 0.5 <= response.json()[0]["score"] < 1
+
+
+def test_trigrams_follow_edited_and_deleted_books(uut: TestClient, caplog):
+    """test that the trigrams of a book are replaced when it is edited and
+    removed when it is deleted"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    book = BookTable(Book(
+        key=-1,
+        title="Trigram",
+        author="Indexer",
+        publisher="Carlsen",
+        number="9550",
+        shorthand="Car",
+        category="Fantasy",
+    ))
+    session.add(book)
+    session.commit()
+    book_key = book.key
+
+    def stored_trigrams():
+        session.commit()
+        return {
+            i.trigram for i in session.query(BookTrigramTable).filter(
+                BookTrigramTable.book_key == book_key)
+        }
+    # when
+    uut.patch("/books/", json={
+        "key": book_key,
+        "title": "Zauberlehrling",
+        "author": "Indexer",
+        "publisher": "Carlsen",
+        "number": "9550",
+        "shorthand": "Car",
+        "category": "Fantasy",
+    })
+    edited = stored_trigrams()
+    uut.delete(f"/books/{book_key}")
+    deleted = stored_trigrams()
+    # then
+    assert edited == book_trigrams("Zauberlehrling", "Indexer")
+    assert deleted == set()
+
+
+def test_lookup_book_by_isbn10(uut: TestClient, caplog):
+    """test that a book stored with a hyphenated ISBN-10 is found by the
+    scanned ISBN-13"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put("/books/", json={
+        "key": -1,
+        "title": "Jim Knopf",
+        "author": "Michael Ende",
+        "publisher": "Thienemann",
+        "number": "9600",
+        "shorthand": "Thi",
+        "category": "Fantasy",
+        "isbn": "3-522-17000-9",
+    })
+    # when
+    response = uut.get("/books/lookup/9783522170000")
+    # then
+    assert response.json()["status"] == "book available"
+    assert response.json()["title"] == "Jim Knopf"
+
+
+def test_lookup_book_with_invalid_code(uut: TestClient, caplog):
+    """test that codes that look like numbers but are no shelf number are
+    reported as unknown books"""
+    # given
+    caplog.set_level(logging.INFO)
+    # when
+    responses = [
+        uut.get(f"/books/lookup/{code}")
+        for code in ["\u00b2", "99999999999999999999999"]
+    ]
+    # then
+    assert [i.status_code for i in responses] == [200, 200]
+    assert [i.json()["status"] for i in responses] == ["book unknown"] * 2
+
+
+def test_books_do_not_contain_internal_columns(uut: TestClient, caplog):
+    """test that the normalized isbn is not part of the book listings"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put("/books/", json={
+        "key": -1,
+        "title": "Internals",
+        "author": "Hider",
+        "publisher": "Carlsen",
+        "number": "9750",
+        "shorthand": "Car",
+        "category": "Fantasy",
+        "isbn": "3-551-58128-2",
+    })
+    # when
+    responses = [
+        uut.get("/books/"),
+        uut.get("/books/available"),
+        uut.get("/books/search", params={"q": "internals"}),
+        uut.get("/books/search", params={"q": "internals", "mode": "fuzzy"}),
+    ]
+    # then
+    assert all(i.json() for i in responses)
+    assert not any(
+        "isbn_normalized" in book for i in responses for book in i.json())
+
+
+def test_typeahead_users(uut: TestClient, caplog):
+    """test that a new user is found by the beginnings of the lastname and
+    the class"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put("/users/", json={
+        "firstname": "Tilda",
+        "lastname": "Typeahead",
+        "classname": "6e",
+    })
+    # when
+    response = uut.get("/users/typeahead", params={"q": "typea 6e"})
+    # then
+    assert [(i["firstname"], i["lastname"]) for i in response.json()] == [
+        ("Tilda", "Typeahead")
+    ]
+
+
+def test_cached_available_books_are_invalidated(uut: TestClient, caplog):
+    """test that the cached list of available books is served from the
+    cache until a borrowing changes it"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put("/users/", json={
+        "firstname": "Cara",
+        "lastname": "Cache",
+        "classname": "8a",
+    })
+    uut.put("/books/", json={
+        "key": -1,
+        "title": "Cached",
+        "author": "Cacher",
+        "publisher": "Carlsen",
+        "number": "9700",
+        "shorthand": "Car",
+        "category": "Fantasy",
+    })
+    user_key = uut.get("/users/typeahead", params={"q": "cache"}).json()[0]["key"]
+    book_key = uut.get("/books/typeahead", params={"q": "cached"}).json()[0]["key"]
+    uut.get("/books/available")
+    hits = uut.get("/stats/cache").json()["hits"]
+    # when
+    cached = uut.get("/books/available").json()
+    uut.patch(f"/workflows/borrow/{user_key}/{book_key}")
+    response = uut.get("/books/available").json()
+    # then
+    assert uut.get("/stats/cache").json()["hits"] == hits + 1
+    assert book_key in [i["key"] for i in cached]
+    assert book_key not in [i["key"] for i in response]
+
+
+def wait_for_import(uut: TestClient, job_id: str, timeout: float = 10):
+    """polls the import job with the id `job_id` until it is finished and
+    returns its last state"""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = uut.get(f"/imports/{job_id}").json()
+        if job["finished"] is not None or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
+def test_borrow_book_taken_concurrently(uut: TestClient, caplog, monkeypatch):
+    """test that a book borrowed by someone else between the lookup and the
+    insert is reported as already borrowed instead of failing"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    first = UserTable(User(key=-1, firstname="Fast",
+                           lastname="Borrower", classname="7a"))
+    second = UserTable(User(key=-1, firstname="Slow",
+                            lastname="Borrower", classname="7a"))
+    book = BookTable(Book(
+        key=-1,
+        title="Race",
+        author="Racer",
+        publisher="Carlsen",
+        number="9970",
+        shorthand="Car",
+        category="Race",
+    ))
+    session.add_all([first, second, book])
+    session.commit()
+    uut.patch(f"/workflows/borrow/{first.key}/{book.key}")
+    lookup_loan = workflows_router.lookup_loan
+
+    def lookup_free_book(session, user_key, book_key):
+        return SimpleNamespace(**{
+            **lookup_loan(session, user_key, book_key)._asdict(),
+            "borrowed": False,
+        })
+    monkeypatch.setattr(workflows_router, "lookup_loan", lookup_free_book)
+    # when
+    response = uut.patch(f"/workflows/borrow/{second.key}/{book.key}")
+    # then
+    assert response.status_code == 200
+    assert response.json()["status"] == "already borrowed"
+    assert session.query(BorrowingUserTable).filter(
+        BorrowingUserTable.book_key == book.key).count() == 1
+
+
+def test_migration_closes_duplicate_open_loans(tmpdir, caplog):
+    """test that the migration of a database that let a book be borrowed
+    twice keeps the newest loan open and creates the unique index"""
+    # given
+    caplog.set_level(logging.INFO)
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmpdir.join('old.db')}")
+    Base.metadata.create_all(engine)
+    loans = BorrowingUserTable.__table__
+    with engine.begin() as connection:
+        connection.execute("DROP INDEX ux_borrowing_users_open_book_key")
+        connection.execute(loans.insert(), [
+            {"key": key, "book_key": 1, "user_key": key,
+             "start_date": start, "expiration_date": start + relativedelta(weeks=3)}
+            for key, start in [(1, date(2020, 9, 1)), (2, date(2020, 9, 7)),
+                               (3, date(2020, 9, 14))]
+        ])
+    # when
+    migrate(engine)
+    # then
+    with engine.connect() as connection:
+        return_dates = dict(connection.execute(
+            sqlalchemy.select([loans.c.key, loans.c.return_date])).fetchall())
+        indexes = [i["name"] for i in sqlalchemy.inspect(
+            connection).get_indexes(loans.name)]
+    assert return_dates == {
+        1: date(2020, 9, 14), 2: date(2020, 9, 14), 3: None}
+    assert "ux_borrowing_users_open_book_key" in indexes
+
+
+def test_import_users_csv_job(uut: TestClient, caplog):
+    """test that an uploaded csv is imported in the background and the job
+    can be polled until it succeeded"""
+    # given
+    caplog.set_level(logging.INFO)
+    csv = (
+        "firstname,lastname,classname\n"
+        "Ida,Importer,1a\n"
+        "Jan,Importer,1b\n"
+    )
+    # when
+    response = uut.post(
+        "/users/import/csv/", files={"file": ("users.csv", csv.encode())})
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert response.status_code == 202
+    assert response.json()["status"] in ["import queued", "import running"]
+    assert job["status"] == "successfully imported"
+    assert job["rows_parsed"] == 2
+    assert job["rows_inserted"] == 2
+    assert len(uut.get("/users/typeahead", params={"q": "importer"}).json()) == 2
+
+
+def test_get_import_job_of_other_worker(uut: TestClient, caplog):
+    """test that an import job run by another worker process is polled from
+    the database"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    session.add(ImportJobTable(
+        job_id="other-worker",
+        kind="users",
+        status="import failed",
+        created=datetime(2020, 9, 1, 8),
+        finished=datetime(2020, 9, 1, 9),
+        rows_parsed=3,
+        errors=json.dumps(["broken row"]),
+    ))
+    session.commit()
+    # when
+    response = uut.get("/imports/other-worker")
+    # then
+    assert response.status_code == 200
+    assert response.json()["status"] == "import failed"
+    assert response.json()["rows_parsed"] == 3
+    assert response.json()["rows_inserted"] == 0
+    assert response.json()["errors"] == ["broken row"]
+
+
+def test_import_malformed_csv_job_fails(uut: TestClient, caplog):
+    """test that an import of a malformed csv ends as failed and reports
+    the error"""
+    # given
+    caplog.set_level(logging.INFO)
+    csv = (
+        "firstname,lastname,classname\n"
+        "Ida,Importer,1a\n"
+        "Jan,Importer,1b,too,many,fields\n"
+    )
+    # when
+    response = uut.post(
+        "/users/import/csv/", files={"file": ("users.csv", csv.encode())})
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert job["status"] == "import failed"
+    assert job["errors"]
+
+
+def test_get_unknown_import_job(uut: TestClient, caplog):
+    """test that polling an unknown import job returns 404"""
+    # given
+    caplog.set_level(logging.INFO)
+    # when
+    response = uut.get("/imports/unknown")
+    # then
+    assert response.status_code == 404
+
+
+def test_merge_books_csv(uut: TestClient, caplog):
+    """test that a merge import inserts new books, updates changed books
+    and leaves unchanged books alone"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    session.add_all([
+        BookTable(Book(
+            key=-1,
+            title=f"Merge {i}",
+            author="Merger",
+            publisher="Carlsen",
+            number=str(9800 + i),
+            shorthand="Car",
+            category="Fantasy",
+            isbn="3-551-58128-2",
+        ))
+        for i in range(2)
+    ])
+    session.commit()
+    csv = (
+        "title,author,publisher,number,shorthand,category,isbn\n"
+        "Merge 0,Merger,Carlsen,9800,Car,Fantasy,3-551-58128-2\n"
+        "Merge 1 revised,Merger,Carlsen,9801,Car,Fantasy,3-551-58128-2\n"
+        "Merge 2,Merger,Carlsen,9802,Car,Fantasy,\n"
+    )
+    # when
+    response = uut.post(
+        "/books/import/csv/",
+        params={"mode": "merge"},
+        files={"file": ("books.csv", csv.encode())}
+    )
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert job["status"] == "successfully imported"
+    assert (job["rows_inserted"], job["rows_updated"], job["rows_unchanged"]) == (
+        1, 1, 1)
+    books = {
+        i.number: (i.title, i.isbn_normalized)
+        for i in session.query(BookTable).filter(
+            BookTable.number.between(9800, 9802))
+    }
+    assert books == {
+        9800: ("Merge 0", "9783551581280"),
+        9801: ("Merge 1 revised", "9783551581280"),
+        9802: ("Merge 2", None),
+    }
+
+
+def test_import_books_csv_skips_invalid_rows(uut: TestClient, caplog):
+    """test that the import drops rows with missing values, numbers that
+    are no integers and duplicate numbers and stores all other rows"""
+    # given
+    caplog.set_level(logging.INFO)
+    csv = (
+        "title,author,publisher,number,shorthand,category,isbn\n"
+        "Valid 0,Validator,Carlsen,9850,Car,Fantasy,3-551-58128-2\n"
+        "Valid 1, Validator ,Carlsen,9851.0,Car,Fantasy,\n"
+        "No author,,Carlsen,9852,Car,Fantasy,\n"
+        "No number,Validator,Carlsen,abc,Car,Fantasy,\n"
+        "Fraction,Validator,Carlsen,9853.5,Car,Fantasy,\n"
+        "Duplicate,Validator,Carlsen,9850,Car,Fantasy,\n"
+    )
+    # when
+    response = uut.post(
+        "/books/import/csv/", files={"file": ("books.csv", csv.encode())})
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert job["status"] == "successfully imported"
+    assert (job["rows_parsed"], job["rows_invalid"],
+            job["duplicates_skipped"], job["rows_inserted"]) == (6, 3, 1, 2)
+    session = Session()
+    books = session.query(BookTable).filter(
+        BookTable.number.between(9850, 9853)).order_by(BookTable.number).all()
+    assert [(i.title, i.author, i.isbn_normalized) for i in books] == [
+        ("Valid 0", "Validator", "9783551581280"),
+        ("Valid 1", "Validator", None),
+    ]
+
+
+def test_import_books_csv_in_chunks(uut: TestClient, caplog, monkeypatch):
+    """test that a csv larger than the chunk size is imported completely"""
+    # given
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr(importer, "IMPORT_CHUNK_SIZE", 10)
+    csv = "title,author,publisher,number,shorthand,category\n" + "".join(
+        f"Chunk {i},Chunker,Carlsen,{9900 + i},Car,Fantasy\n" for i in range(25)
+    )
+    # when
+    response = uut.post(
+        "/books/import/csv/", files={"file": ("books.csv", csv.encode())})
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert job["status"] == "successfully imported"
+    assert (job["rows_parsed"], job["rows_inserted"]) == (25, 25)
+    assert caplog.text.count("importing books chunk") == 3
+    session = Session()
+    assert session.query(BookTable).filter(
+        BookTable.author == "Chunker").count() == 25
+
+
+def test_import_users_csv_in_cp1252(uut: TestClient, caplog):
+    """test that a csv that is not utf-8 encoded is decoded correctly"""
+    # given
+    caplog.set_level(logging.INFO)
+    csv = (
+        "firstname,lastname,classname\n"
+        "Jürgen,Größer,3a\n"
+        "Zoë,Weiß,3a\n"
+    )
+    # when
+    response = uut.post(
+        "/users/import/csv/",
+        files={"file": ("users.csv", csv.encode("cp1252"))}
+    )
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert job["status"] == "successfully imported"
+    session = Session()
+    users = session.query(UserTable).filter(
+        UserTable.lastname.in_(["Größer", "Weiß"])).order_by(UserTable.key)
+    assert [(i.firstname, i.lastname) for i in users] == [
+        ("Jürgen", "Größer"),
+        ("Zoë", "Weiß"),
+    ]
+
+
+def test_export_books_csv(uut: TestClient, caplog):
+    """test that the csv export contains every book with the export columns"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    count = session.query(BookTable).count()
+    # when
+    response = uut.get("/books/export/csv/")
+    # then
+    df = pd.read_csv(io.BytesIO(response.content), encoding="iso-8859-1")
+    assert response.status_code == 200
+    assert list(df.columns) == [
+        "title", "author", "publisher", "shorthand", "number", "category", "isbn"]
+    assert len(df.index) == count
+    assert set(df.number) == {i.number for i in session.query(BookTable.number)}
+
+
+@pytest.mark.parametrize("export_format", ["ndjson", "arrow", "parquet"])
+def test_export_books(uut: TestClient, caplog, export_format):
+    """test that the machine readable exports contain every book with its
+    key and the export columns"""
+    # given
+    caplog.set_level(logging.INFO)
+    session = Session()
+    keys = {i.key for i in session.query(BookTable.key)}
+    # when
+    response = uut.get(f"/books/export/{export_format}/")
+    # then
+    content = io.BytesIO(response.content)
+    if export_format == "ndjson":
+        df = pd.read_json(content, lines=True)
+    elif export_format == "arrow":
+        df = pyarrow.ipc.open_stream(content).read_pandas()
+    else:
+        df = pyarrow.parquet.read_table(content).to_pandas()
+    assert response.status_code == 200
+    assert list(df.columns) == [
+        "key", "title", "author", "publisher", "shorthand", "number",
+        "category", "isbn"]
+    assert len(df.index) == len(keys)
+    assert set(df.key) == keys
+
+
+def test_export_books_in_unknown_format(uut: TestClient, caplog):
+    """test that an export in an unknown format is rejected"""
+    # given
+    caplog.set_level(logging.INFO)
+    # when
+    response = uut.get("/books/export/xlsx/")
+    # then
+    assert response.status_code == 422
+
+
+def png_image(color: str, size=(40, 60)) -> bytes:
+    """returns a png of `size` pixels filled with `color`"""
+    f = io.BytesIO()
+    Image.new("RGB", size, color).save(f, "PNG")
+    return f.getvalue()
+
+
+@pytest.fixture
+def cover_book():
+    """key of a book without cover, its cover is deleted afterwards"""
+    session = Session()
+    book = BookTable(Book(
+        key=-1,
+        title="Covered",
+        author="Uploader",
+        publisher="Carlsen",
+        number="9950",
+        shorthand="Car",
+        category="Fantasy",
+    ))
+    session.add(book)
+    session.commit()
+    yield book.key
+    path = os.path.join("data/media", f"{book.key}.png")
+    if os.path.exists(path):
+        os.remove(path)
+    session.delete(book)
+    session.commit()
+
+
+def test_upload_book_cover(uut: TestClient, caplog, cover_book):
+    """test that an uploaded image is stored as png cover, found by the
+    cover index and that its thumbnail follows a replaced cover"""
+    # given
+    caplog.set_level(logging.INFO)
+    # when
+    red = uut.put(f"/media/{cover_book}",
+                  files={"file": ("cover.png", png_image("red"))})
+    exists = uut.get(f"/media/exists/{cover_book}").json()
+    red_thumbnail = uut.get(f"/media/{cover_book}", params={"w": 20})
+    blue = uut.put(f"/media/{cover_book}",
+                   files={"file": ("cover.png", png_image("blue"))})
+    blue_thumbnail = uut.get(f"/media/{cover_book}", params={"w": 20})
+    # then
+    assert [red.json()["status"], blue.json()["status"]] == [
+        "cover uploaded", "cover uploaded"]
+    assert exists == "True"
+    assert uut.post("/media/exists", json=[cover_book]).json() == [cover_book]
+    assert Image.open(io.BytesIO(
+        uut.get(f"/media/{cover_book}").content)).format == "PNG"
+    assert red_thumbnail.headers["content-type"] == "image/jpeg"
+    assert red_thumbnail.headers["etag"] != blue_thumbnail.headers["etag"]
+    assert Image.open(io.BytesIO(blue_thumbnail.content)).getpixel(
+        (0, 0))[2] > 200
+
+
+def test_upload_invalid_book_cover(uut: TestClient, caplog, cover_book):
+    """test that a file that is no image is rejected and not stored"""
+    # given
+    caplog.set_level(logging.INFO)
+    # when
+    response = uut.put(f"/media/{cover_book}",
+                       files={"file": ("cover.png", b"no image at all")})
+    # then
+    assert response.json()["status"] == "file is not an image"
+    assert uut.get(f"/media/exists/{cover_book}").json() == "False"
+    assert not [i for i in os.listdir("data/media") if i.endswith(".upload")]
+
+
+def test_upload_too_large_book_cover(uut: TestClient, caplog, cover_book, monkeypatch):
+    """test that a cover larger than the limit is rejected and not stored"""
+    # given
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr(uploads, "MAX_COVER_SIZE", 100)
+    # when
+    response = uut.put(f"/media/{cover_book}",
+                       files={"file": ("cover.png", png_image("red", (400, 400)))})
+    # then
+    assert response.json()["status"] == "cover too large"
+    assert uut.get(f"/media/exists/{cover_book}").json() == "False"
+    assert not [i for i in os.listdir("data/media") if i.endswith(".upload")]
+
+
+def test_thumbnail_width_is_rounded_up(uut: TestClient, caplog, cover_book):
+    """test that thumbnails are only rendered in the supported widths"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put(f"/media/{cover_book}",
+            files={"file": ("cover.png", png_image("red", (600, 900)))})
+    # when
+    small = uut.get(f"/media/{cover_book}", params={"w": 100})
+    large = uut.get(f"/media/{cover_book}", params={"w": 1000})
+    # then
+    assert Image.open(io.BytesIO(small.content)).width == 128
+    assert Image.open(io.BytesIO(large.content)).width == 512
+
+
+def test_missing_thumbnail_is_rendered_again(uut: TestClient, caplog, cover_book):
+    """test that a thumbnail deleted behind the back of the cache is
+    rendered again instead of failing"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.put(f"/media/{cover_book}",
+            files={"file": ("cover.png", png_image("red"))})
+    uut.get(f"/media/{cover_book}", params={"w": 64})
+    for name in list(thumbnails.entries):
+        os.remove(os.path.join(thumbnails.directory, name))
+    # when
+    response = uut.get(f"/media/{cover_book}", params={"w": 64})
+    # then
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+
+
+def test_unreadable_cover_is_served_unscaled(uut: TestClient, caplog, cover_book):
+    """test that a cover pillow can not read is served as it is instead of
+    failing to render its thumbnail"""
+    # given
+    caplog.set_level(logging.INFO)
+    with open(os.path.join("data/media", f"{cover_book}.png"), "wb") as f:
+        f.write(b"no image at all")
+    # when
+    response = uut.get(f"/media/{cover_book}", params={"w": 64})
+    # then
+    assert response.status_code == 200
+    assert response.content == b"no image at all"
+
+
+def test_thumbnail_cache_evicts_least_recently_used(tmpdir, caplog):
+    """test that the cache deletes the least recently used thumbnails once
+    it grows beyond its size"""
+    # given
+    caplog.set_level(logging.INFO)
+    cache = ThumbnailCache(str(tmpdir.mkdir("thumbnails")), 10 ** 9, 1)
+    sources = {}
+    for color, size in [("red", (64, 96)), ("blue", (64, 96)), ("green", (8, 8))]:
+        sources[color] = str(tmpdir.join(f"{color}.png"))
+        Image.new("RGB", size, color).save(sources[color], "PNG")
+
+    async def render():
+        red = await cache.get(sources["red"], 64)
+        blue = await cache.get(sources["blue"], 64)
+        cache.max_size = cache.size
+        await cache.get(sources["red"], 64)
+        green = await cache.get(sources["green"], 64)
+        return red, blue, green
+    # when
+    try:
+        red, blue, green = asyncio.run(render())
+    finally:
+        cache.close()
+    # then
+    assert os.path.exists(red) and os.path.exists(green)
+    assert not os.path.exists(blue)
+    assert cache.size <= cache.max_size
+    assert cache.size == sum(os.path.getsize(i) for i in [red, green])
+
+
+def test_cached_users_are_invalidated_by_other_workers(uut: TestClient, caplog):
+    """test that a cached listing is computed again once another worker
+    process invalidated it through the shared generations"""
+    # given
+    caplog.set_level(logging.INFO)
+    uut.get("/users/")
+    session = Session()
+    session.add(UserTable(User(key=-1, firstname="Wanda",
+                               lastname="Worker", classname="9b")))
+    session.commit()
+    cached = uut.get("/users/").json()
+    # when
+    session.execute(INCREMENT_GENERATION, {"tag": USERS})
+    session.commit()
+    response = uut.get("/users/").json()
+    # then
+    assert "Worker" not in [i[0]["lastname"] for i in cached]
+    assert "Worker" in [i[0]["lastname"] for i in response]
+
+
+def test_stats_summary_follows_other_workers(uut: TestClient, caplog):
+    """test that the counters are counted again once another worker process
+    changed them through the shared generation"""
+    # given
+    caplog.set_level(logging.INFO)
+    before = uut.post("/stats/recount").json()
+    session = Session()
+    session.add(UserTable(User(key=-1, firstname="Otto",
+                               lastname="Other", classname="9b")))
+    session.commit()
+    # when
+    session.execute(INCREMENT_GENERATION, {"tag": STATISTICS})
+    session.commit()
+    response = uut.get("/stats/summary").json()
+    # then
+    assert response["users"] == before["users"] + 1
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "cp1252"])
+def test_import_users_csv_with_late_umlauts(uut: TestClient, caplog, encoding):
+    """test that umlauts are decoded correctly even if the first of them
+    comes after the first block that is checked for the encoding"""
+    # given
+    caplog.set_level(logging.INFO)
+    filler = "".join(
+        f"Filler{i},Ascii,1a\n"
+        for i in range(importer.ENCODING_BLOCK_SIZE // 16)
+    )
+    lastname = f"Löwenherz-{encoding}"
+    csv = f"firstname,lastname,classname\n{filler}Jürgen,{lastname},3a\n"
+    assert csv.index("ü") > importer.ENCODING_BLOCK_SIZE
+    # when
+    response = uut.post(
+        "/users/import/csv/",
+        files={"file": ("users.csv", csv.encode(encoding))}
+    )
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert job["status"] == "successfully imported"
+    session = Session()
+    user = session.query(UserTable).filter(
+        UserTable.lastname == lastname).one()
+    assert user.firstname == "Jürgen"
+
+
+def test_import_users_csv_with_undecodable_bytes_fails(uut: TestClient, caplog):
+    """test that bytes that are invalid in every supported encoding fail
+    the import instead of being replaced"""
+    # given
+    caplog.set_level(logging.INFO)
+    csv = b"firstname,lastname,classname\nUndecodable,X\x81Y,3a\n"
+    # when
+    response = uut.post(
+        "/users/import/csv/", files={"file": ("users.csv", csv)})
+    job = wait_for_import(uut, response.json()["job_id"])
+    # then
+    assert job["status"] == "import failed"
+    assert Session().query(UserTable).filter(
+        UserTable.firstname == "Undecodable").count() == 0